@@ -0,0 +1,4 @@
+"""Reproducible benchmarks for pyimgbatch.
+
+Run ``python -m benchmarks --help`` from the repository root.
+"""
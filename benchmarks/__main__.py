@@ -0,0 +1,183 @@
+"""Runs the benchmark scenarios on a synthetic corpus.
+
+Every scenario runs in its own process for each size of the corpus, so the
+peak memory is measured per scenario. The process only loads the index of
+the corpus created before, so its peak memory is the one of the batch run.
+The peak memory of the scenario process and of its largest worker process
+are reported, ``peak_rss_mb`` is the larger one of both. The results are
+printed as a table and written as JSON, which can be compared to the results of another commit with
+``--compare``. With ``--backends`` every scenario runs with each of the
+given image processing backends and their speed is compared.
+"""
+import argparse
+import json
+import platform
+import subprocess
+import sys
+import tempfile
+from os.path import join
+from shutil import rmtree
+from time import perf_counter
+
+from .corpus import SIZES, create_corpus, load_corpus
+from .scenarios import SCENARIOS, scenario_project
+
+
+def peak_rss_mb(who='self'):
+    """peak memory of this process or, with who='children', of its largest
+    finished child process, like a worker of the process pool"""
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_CHILDREN if who == 'children' else resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macOS
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def run_scenario(name, source, files, jobs=1, repeat=1, backend='pillow'):
+    """runs one scenario in this process and returns its measurements"""
+    from pyimgbatch.pyimgbatch import PyImgBatch
+
+    timings = []
+    for _ in range(repeat):
+        dest = tempfile.mkdtemp(prefix='pyimgbatch-bench-')
+        try:
+            project = scenario_project(name, source, dest, jobs=jobs, manifest=False, backend=backend)
+            batch = PyImgBatch({'no_progress': True, 'override': True}, {'projects': [project]})
+            start = perf_counter()
+            batch.exec()
+            timings.append(perf_counter() - start)
+        finally:
+            rmtree(dest, ignore_errors=True)
+    seconds = min(timings)
+    megapixels = sum(corpus_file['megapixels'] for corpus_file in files)
+    return {'seconds': seconds,
+            'images': len(files),
+            'images_per_second': len(files) / seconds,
+            'megapixels_per_second': megapixels / seconds,
+            'peak_rss_mb': max(peak_rss_mb(), peak_rss_mb('children')),
+            'main_rss_mb': peak_rss_mb(),
+            'worker_rss_mb': peak_rss_mb('children')}
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def available_backends(backends):
+    from pyimgbatch.pyimgbatch import BACKENDS
+
+    available = [backend for backend in backends if BACKENDS[backend].available]
+    for backend in sorted(set(backends) - set(available)):
+        print(f"skipping backend {backend}, it is not available")
+    return available
+
+
+def run_all(args):
+    backends = available_backends(args.backends)
+    corpus_folder = args.corpus or tempfile.mkdtemp(prefix='pyimgbatch-corpus-')
+    corpus = create_corpus(corpus_folder, sizes=args.sizes, count=args.count, cmyk_profile=args.cmyk_profile)
+    results = []
+    for name in args.scenarios:
+        for size in args.sizes:
+            for backend in backends:
+                command = [sys.executable, '-m', 'benchmarks', '--run-one', name,
+                           '--corpus', corpus_folder, '--sizes', size, '--backends', backend,
+                           '--jobs', str(args.jobs), '--repeat', str(args.repeat)]
+                output = subprocess.run(command, capture_output=True, text=True, check=True).stdout
+                result = json.loads(output.strip().splitlines()[-1])
+                result.update({'scenario': name, 'size': size, 'backend': backend})
+                results.append(result)
+                print_result(result)
+    report = {'revision': git_revision(),
+              'python': platform.python_version(),
+              'machine': platform.machine(),
+              'corpus': corpus['description'],
+              'jobs': args.jobs,
+              'results': results}
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(report, output_file, indent=2)
+    if args.compare:
+        compare(args.compare, report)
+    if len(backends) > 1:
+        compare_backends(report)
+    if not args.corpus:
+        rmtree(corpus_folder, ignore_errors=True)
+    return report
+
+
+def print_result(result):
+    print(f"{result['scenario']:<24}{result['size']:<8}{result['backend']:<8}{result['images']:>6} images"
+          f"{result['images_per_second']:>10.2f} img/s{result['megapixels_per_second']:>10.2f} MP/s"
+          f"{result['main_rss_mb']:>10.1f} MB main{result['worker_rss_mb']:>10.1f} MB worker")
+
+
+def compare(baseline_filename, report):
+    """prints the change of the throughput against an earlier report"""
+    with open(baseline_filename) as baseline_file:
+        baseline = json.load(baseline_file)
+    previous = {(result['scenario'], result['size'], result.get('backend', 'pillow')): result
+                for result in baseline['results']}
+    print(f"\ncompared to {baseline.get('revision')}:")
+    for result in report['results']:
+        before = previous.get((result['scenario'], result['size'], result['backend']))
+        if before is None:
+            continue
+        change = result['megapixels_per_second'] / before['megapixels_per_second'] - 1
+        rss_change = result['peak_rss_mb'] - before['peak_rss_mb']
+        print(f"{result['scenario']:<24}{result['size']:<8}{result['backend']:<8}"
+              f"{change:>+10.1%} MP/s{rss_change:>+10.1f} MB")
+
+
+def compare_backends(report):
+    """prints the throughput of every backend relative to the first backend"""
+    results = {}
+    for result in report['results']:
+        results.setdefault((result['scenario'], result['size']), []).append(result)
+    print(f"\ncompared to {report['results'][0]['backend']}:")
+    for (scenario, size), scenario_results in results.items():
+        first = scenario_results[0]
+        for result in scenario_results[1:]:
+            speedup = result['megapixels_per_second'] / first['megapixels_per_second']
+            rss_change = result['peak_rss_mb'] - first['peak_rss_mb']
+            print(f"{scenario:<24}{size:<8}{result['backend']:<8}{speedup:>10.2f}x MP/s{rss_change:>+10.1f} MB")
+
+
+def get_args():
+    parser = argparse.ArgumentParser(prog='python -m benchmarks', description=__doc__)
+    parser.add_argument('--scenarios', nargs='+', choices=list(SCENARIOS), default=list(SCENARIOS),
+                        help='scenarios to run, defaults to all.')
+    parser.add_argument('--sizes', nargs='+', choices=list(SIZES), default=['small', 'medium'],
+                        help='image sizes of the corpus, defaults to small and medium.')
+    parser.add_argument('--count', type=int, default=2, help='images per size and kind.')
+    parser.add_argument('--corpus', type=str, default=None,
+                        help='folder of the corpus, it is created once and reused. defaults to a temporary folder.')
+    parser.add_argument('--cmyk-profile', type=str, default=None,
+                        help='ICC profile file embedded into CMYK images. Without it, CMYK images have no profile.')
+    parser.add_argument('--backends', nargs='+', choices=['pillow', 'vips'], default=['pillow'],
+                        help='image processing backends, every scenario runs with each of them. defaults to pillow.')
+    parser.add_argument('--jobs', type=int, default=1, help='jobs used for pyimgbatch.')
+    parser.add_argument('--repeat', type=int, default=1, help='runs per scenario, the fastest run counts.')
+    parser.add_argument('--output', type=str, default=None, help='JSON file for the results.')
+    parser.add_argument('--compare', type=str, default=None, help='JSON results of an earlier run to compare with.')
+    parser.add_argument('--run-one', type=str, default=None, help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+    if args.run_one:
+        corpus = load_corpus(args.corpus)
+        files = [corpus_file for corpus_file in corpus['files'] if corpus_file['size'] == args.sizes[0]]
+        result = run_scenario(args.run_one, join(args.corpus, args.sizes[0]), files,
+                              jobs=args.jobs, repeat=args.repeat, backend=args.backends[0])
+        print(json.dumps(result))
+    else:
+        run_all(args)
+
+
+if __name__ == "__main__":
+    main()
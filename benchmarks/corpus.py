@@ -0,0 +1,95 @@
+import json
+import random
+from os import makedirs
+from os.path import join, exists
+
+from PIL import Image, ImageCms
+
+# megapixels of the corpus sizes
+SIZES = {'small': 0.25, 'medium': 2, 'large': 12, 'huge': 50}
+
+FORMATS = {'jpg': 'JPEG', 'png': 'PNG', 'tif': 'TIFF'}
+
+# (format, mode, with embedded ICC profile)
+KINDS = [('jpg', 'RGB', False),
+         ('jpg', 'RGB', True),
+         ('jpg', 'CMYK', False),
+         ('png', 'RGB', False),
+         ('png', 'RGBA', True),
+         ('tif', 'RGB', True),
+         ('tif', 'CMYK', False),
+         ('tif', 'CMYK', True)]
+
+ASPECT = 3 / 2
+CORPUS_FILENAME = 'corpus.json'
+
+
+def image_size(megapixels):
+    height = int((megapixels * 1000000 / ASPECT) ** 0.5)
+    return int(height * ASPECT), height
+
+
+def synthetic_image(size, mode, seed):
+    """deterministic test image: gradients with a structure of random noise,
+    so the encoders and resamplers get some detail to work on"""
+    rng = random.Random(seed)
+    tile = Image.frombytes('L', (256, 256), rng.getrandbits(8 * 256 * 256).to_bytes(256 * 256, 'little'))
+    noise = tile.resize((max(size[0] // 8, 1), max(size[1] // 8, 1)), Image.NEAREST).resize(size, Image.BILINEAR)
+    gradient = Image.linear_gradient('L').resize(size)
+    radial = Image.radial_gradient('L').resize(size)
+    image = Image.merge('RGB', (gradient, radial, noise))
+    if mode == 'RGBA':
+        image.putalpha(radial)
+    elif mode != 'RGB':
+        image = image.convert(mode)
+    return image
+
+
+def icc_profile(mode, cmyk_profile=None):
+    if mode == 'CMYK':
+        if cmyk_profile is None:
+            return None
+        with open(cmyk_profile, 'rb') as profile_file:
+            return profile_file.read()
+    return ImageCms.ImageCmsProfile(ImageCms.createProfile('sRGB')).tobytes()
+
+
+def load_corpus(folder):
+    """returns the description of the corpus in `folder` without creating any images"""
+    with open(join(folder, CORPUS_FILENAME)) as index_file:
+        return json.load(index_file)
+
+
+def create_corpus(folder, sizes=('small', 'medium'), count=2, cmyk_profile=None, seed=42):
+    """creates the corpus in `folder`, one subfolder per size, and returns its
+    description.
+
+    The corpus only depends on the arguments, so an existing corpus with the
+    same description is reused.
+    """
+    description = {'sizes': list(sizes), 'count': count, 'cmyk_profile': cmyk_profile, 'seed': seed}
+    index_filename = join(folder, CORPUS_FILENAME)
+    if exists(index_filename):
+        with open(index_filename) as index_file:
+            corpus = json.load(index_file)
+        if corpus['description'] == description:
+            return corpus
+    files = []
+    for size_name in sizes:
+        size = image_size(SIZES[size_name])
+        makedirs(join(folder, size_name), exist_ok=True)
+        for ext, mode, with_icc in KINDS:
+            profile = icc_profile(mode, cmyk_profile) if with_icc else None
+            if with_icc and profile is None:
+                continue
+            for index in range(count):
+                name = f"{size_name}-{mode.lower()}{'-icc' if with_icc else ''}-{index}.{ext}"
+                image = synthetic_image(size, mode, f"{seed}-{name}")
+                save_args = {'icc_profile': profile} if profile else {}
+                image.save(join(folder, size_name, name), FORMATS[ext], **save_args)
+                files.append({'name': name, 'size': size_name, 'format': ext, 'mode': mode,
+                              'icc': with_icc, 'megapixels': size[0] * size[1] / 1000000})
+    corpus = {'description': description, 'files': files}
+    with open(index_filename, 'w') as index_file:
+        json.dump(corpus, index_file, indent=2)
+    return corpus
@@ -0,0 +1,39 @@
+import json
+from os.path import dirname, join
+
+EXAMPLES = join(dirname(dirname(__file__)), 'examples')
+
+
+def _load(filename):
+    with open(join(EXAMPLES, filename)) as project_file:
+        return json.load(project_file)
+
+
+def webset():
+    """the web set of examples/pyimgbatch-short.json, 12 outputs per image"""
+    project = _load('pyimgbatch-short.json')
+    return {'prefix': project['prefix'], 'configs': project['configs']}
+
+
+def thumbnails():
+    """the thumbnails project of examples/pyimgbatch.json, 2 outputs per image"""
+    project = _load('pyimgbatch.json')['projects'][1]
+    return {'prefix': project['prefix'], 'configs': project['configs']}
+
+
+# name -> (project without source and dest, additional options)
+SCENARIOS = {
+    'webset': (webset, {}),
+    'webset-cascade': (webset, {'cascade': True}),
+    'thumbnails': (thumbnails, {}),
+    'thumbnails-fast-decode': (thumbnails, {'fast_decode': True}),
+}
+
+
+def scenario_project(name, source, dest, **options):
+    create_project, scenario_options = SCENARIOS[name]
+    project = create_project()
+    project.update(scenario_options)
+    project.update(options)
+    project.update({'source': source, 'dest': dest})
+    return project
@@ -0,0 +1 @@
+from .pyimgbatch import PyImgBatch, process_images, aprocess_images
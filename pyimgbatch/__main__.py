@@ -2,25 +2,41 @@ import sys, os
 import argparse
 import logging
 # from pprint import pprint
-from .pyimgbatch import PyImgBatch
+from .pyimgbatch import PyImgBatch, parse_shard, start_logging
+from .watch import Watcher
 
 
 def main():
     """simply main
     """
     args = get_args()
-    logging_level = logging.DEBUG if not args.nolog else logging.ERROR
-    logging.basicConfig(level=logging_level,
-                        filename=args.logfile,
-                        filemode='w',
-                        format='%(name)s - %(levelname)s - %(message)s')
-    if args.debug:
-        logging.getLogger().setLevel(logging_level)
-    logging.debug(args)
-    if args.silent:
+    logging_level = logging.ERROR if args.nolog else logging.DEBUG if args.debug else logging.INFO
+    listener = start_logging(args.logfile, logging_level)
+    try:
+        run(args)
+    finally:
+        listener.stop()
+
+
+def run(args):
+    logging.debug("%s", args)
+    if args.silent and not args.print_plan and not args.plan and args.command not in ('serve', 'merge'):
         sys.stdout = open(os.devnull, 'w')
     pib = PyImgBatch(prepare_arguments(args))
-    pib.exec()
+    if args.print_plan:
+        pib.print_plan()
+    elif args.plan:
+        pib.estimate()
+    elif args.command == 'merge':
+        sys.exit(0 if pib.merge() else 1)
+    elif args.command == 'serve':
+        from .server import serve
+        serve(pib.options, host=args.host, port=args.port, cache_dir=args.cache_dir,
+              cache_size=args.cache_size * 1024 * 1024, memory_size=args.memory_cache * 1024 * 1024)
+    elif args.watch:
+        Watcher(pib.options, interval=args.watch_interval).run()
+    else:
+        pib.exec()
 
 
 def prepare_arguments(args):
@@ -31,6 +47,9 @@ def prepare_arguments(args):
 
 def get_args():
     parser = argparse.ArgumentParser()
+    parser.add_argument('command', nargs='?', choices=['serve', 'merge'],
+                        default=None, help='"serve" renders the outputs on request by a HTTP server instead of processing all images. '
+                                           '"merge" merges the manifests of sharded runs and checks that every output was done once.')
 
     file_handling_group = parser.add_argument_group('file handling')
     file_handling_group.add_argument('-c', '--configfile', type=str,
@@ -41,18 +60,77 @@ def get_args():
                                      default='.', help='source folder containing images for batch processing')
     file_handling_group.add_argument('-d', '--dest', type=str, default='dest',
                                      help='destination folder for the processed images')
+    file_handling_group.add_argument('-r', '--recursive', action='store_true',
+                                     default=False, help='includes images in subfolders of the source folder.')
+    file_handling_group.add_argument('--include', type=str, action='append',
+                                     default=None, help='file name pattern of source images, may be repeated. defaults to supported image types.')
+    file_handling_group.add_argument('--exclude', type=str, action='append',
+                                     default=None, help='file name or path pattern to skip, may be repeated.')
     file_handling_group.add_argument('-o', '--override', action='store_true',
                                      default=False, help='overrides existing files')
+    file_handling_group.add_argument('--resume', action='store_true',
+                                     default=False, help='continues an interrupted run, skipping the images it has done.')
+    file_handling_group.add_argument('--no-manifest', dest='manifest', action='store_false',
+                                     default=True, help='checks only the existence of outputs instead of the manifest.')
+    file_handling_group.add_argument('--hash-sources', action='store_true',
+                                     default=False, help='records the content hash of every source in the manifest, so sources touched without changes are skipped.')
+    file_handling_group.add_argument('--dedupe', type=str, choices=["hardlink", "reflink", "copy"],
+                                     default=None, help='renders identical source images once and creates the other outputs as hardlinks, reflinks or copies.')
     file_handling_group.add_argument('--nosubfolder', action='store_true',
                                      default=False, help='overrides existing files')
 
+    processing_group = parser.add_argument_group('processing')
+    processing_group.add_argument('-j', '--jobs', type=int,
+                                  default=None, help='number of parallel workers, 0 uses all cores. defaults to 1.')
+    processing_group.add_argument('--executor', type=str, choices=["process", "thread"],
+                                  default=None, help='kind of the parallel workers, defaults to "process".')
+    processing_group.add_argument('--max-memory', type=int,
+                                  default=None, help='memory budget in MB for parallel workers. Large images are processed first, too large ones alone.')
+    processing_group.add_argument('--pipeline', action='store_true',
+                                  default=False, help='overlaps reading, processing (with --jobs threads) and writing.')
+    processing_group.add_argument('--backend', type=str, choices=["pillow", "vips"],
+                                  default=None, help='image processing backend, defaults to "pillow". "vips" requires pyvips.')
+    processing_group.add_argument('--fast-decode', action='store_true',
+                                  default=False, help='decodes large source images at a reduced scale for small outputs.')
+    processing_group.add_argument('--strict-color', action='store_true',
+                                  default=False, help='converts the colors of the full source image before resizing, instead of converting the smaller outputs.')
+    processing_group.add_argument('--embedded-thumbnail', action='store_true',
+                                  default=False, help='uses the thumbnail embedded in the EXIF data of a JPEG, if it is large enough for all outputs.')
+
+    processing_group.add_argument('--shard', type=parse_shard,
+                                  default=None, help='processes only the K-th of N disjoint parts of the source images, given as K/N.')
+    processing_group.add_argument('--watch', action='store_true',
+                                  default=False, help='keeps running and processes new or modified source images. Requires the manifest.')
+    processing_group.add_argument('--watch-interval', type=float,
+                                  default=2.0, help='seconds between two scans of the source folders in watch mode.')
+
+    serve_group = parser.add_argument_group('serve')
+    serve_group.add_argument('--host', type=str,
+                             default='127.0.0.1', help='address the server listens on.')
+    serve_group.add_argument('--port', type=int,
+                             default=8000, help='port the server listens on.')
+    serve_group.add_argument('--cache-dir', type=str,
+                             default='.pyimgbatch-cache', help='folder of the disk cache of rendered images.')
+    serve_group.add_argument('--cache-size', type=int,
+                             default=512, help='size of the disk cache in MB.')
+    serve_group.add_argument('--memory-cache', type=int,
+                             default=64, help='size of the memory cache in MB.')
+
     output_group = parser.add_argument_group('output / user interaction')
     output_group.add_argument('--no-progress', action='store_true',
                               default=False, help='disables the progress bars')
     output_group.add_argument('--debug', action='store_true',
-                              default=False, help='enables debugging level.')
+                              default=False, help='enables debugging level. By default the log file contains info messages and above.')
     output_group.add_argument('--logfile', type=str,
                               default='pyimgbatch.log', help='log destination file.')
+    output_group.add_argument('--report', type=str,
+                              default=None, help='writes a JSON report of the processing times to the given file.')
+    output_group.add_argument('--events', type=str,
+                              default=None, help='appends the events of the run (source started, finished, skipped, errors, stage times) as JSON lines to the given file.')
+    output_group.add_argument('--print-plan', action='store_true',
+                              default=False, help='prints the resolved settings of all projects and exits.')
+    output_group.add_argument('--plan', action='store_true',
+                              default=False, help='estimates the megapixels and the runtime of the outdated outputs from the image headers and exits. The runtime uses fixed costs per megapixel and is only a rough guess.')
     output_group.add_argument('--nolog', action='store_true',
                               default=False, help='enables log saved in file.')
     output_group.add_argument('--silent', action='store_true',
@@ -66,7 +144,10 @@ def get_args():
     image_manipulation_group.add_argument('--resample', type=str, choices=["none", "bilinear", "bicubic", "hamming", "box", "antialias"],
                                           default="antialias", help='resample arlgorithm used for resizing, defaults to "antialias"')
 
-    return parser.parse_args()
+    args = parser.parse_args()
+    if args.watch and not args.manifest:
+        parser.error('--watch needs the manifest to detect modified sources, it cannot be combined with --no-manifest')
+    return args
 
 
 if __name__ == "__main__":
@@ -1,24 +1,48 @@
 import json
 import logging
+import logging.handlers
+import multiprocessing
 import io
-
-from os import makedirs
-from os.path import basename, join, exists, abspath
-from glob import glob
+import hashlib
+import threading
+import queue
+import asyncio
+import shutil
+import re
+import struct
+import tempfile
+
+from os import makedirs, cpu_count, scandir, stat, replace, link, remove, listdir, close, sep, chmod, umask
+from os.path import basename, dirname, join, exists, abspath, relpath, samefile, splitext
+from fnmatch import fnmatchcase
+from functools import partial
 # from contextlib import suppress
 
 
 from pprint import pformat
+from collections import OrderedDict
 
-from time import time
+from time import time, perf_counter
+from contextlib import contextmanager, nullcontext
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 from PIL import Image
 from PIL import ImageCms
 from tqdm import tqdm
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import pyvips
+except (ImportError, OSError):
+    pyvips = None
+
 
 WEBSETS = {'@2x': 2, '@3x': 3}
-SUPPORTED_FILES = ['*.jpg', '*.jpeg', '*.png', '*.tif']
+SUPPORTED_FILES = ['*.jpg', '*.jpeg', '*.png', '*.tif', '*.tiff']
 
 RESAMPLE_MODES = {'none': Image.NEAREST,
                   'bilinear': Image.BILINEAR,
@@ -26,9 +50,70 @@ RESAMPLE_MODES = {'none': Image.NEAREST,
                   'hamming': Image.HAMMING,
                   'box': Image.BOX,
                   'antialias': Image.ANTIALIAS}
+IMAGE_FORMATS = {'jpg': 'JPEG', 'jpeg': 'JPEG', 'png': 'PNG', 'webp': 'WEBP',
+                 'tif': 'TIFF', 'tiff': 'TIFF', 'gif': 'GIF'}
+# quality range searched for "max_bytes"
+MIN_QUALITY, MAX_QUALITY = 10, 95
+QUALITY_SEARCH_STEPS = 7
+
+RESAMPLE_NAMES = {value: key for key, value in reversed(list(RESAMPLE_MODES.items()))}
+
+FAST_DECODE_HEADROOM = 2
+# modes reduced by Image.reduce, without palettes, whose indexes cannot be averaged, and 1 and 16 bit modes
+REDUCE_MODES = ['L', 'LA', 'RGB', 'RGBA', 'RGBX', 'CMYK', 'YCbCr', 'LAB', 'HSV', 'I', 'F']
+# source modes resized before the color conversion and destination modes converted after resizing,
+# both without alpha channels or palettes, whose conversions depend on more than one pixel
+RESIZE_FIRST_SOURCES = ['L', 'RGB', 'CMYK']
+RESIZE_FIRST_TARGETS = ['L', 'RGB', 'RGBA', 'CMYK']
+# largest relative difference of the aspect ratios of an embedded thumbnail and its source
+EMBEDDED_THUMBNAIL_TOLERANCE = 0.01
+# EXIF tags of the offset and the length of the JPEG thumbnail in IFD1
+EXIF_THUMBNAIL_OFFSET, EXIF_THUMBNAIL_LENGTH = 0x0201, 0x0202
+TRANSFORM_CACHE_SIZE = 32
+BUILTIN_PROFILES = ['sRGB', 'LAB', 'XYZ']
+MANIFEST_FILENAME = '.pyimgbatch-manifest.jsonl'
+SHARD_MANIFEST_FILENAME = '.pyimgbatch-manifest.shard-{index}-of-{count}.jsonl'
+JOURNAL_FILENAME = '.pyimgbatch-journal.jsonl'
+SHARD_JOURNAL_FILENAME = '.pyimgbatch-journal.shard-{index}-of-{count}.jsonl'
+METADATA_FILENAME = '.pyimgbatch-metadata.jsonl'
+# temporary files of `atomic_destination`, named like ".a.jpg.k2x_9f0q.tmp.jpg" by mkstemp
+TEMP_FILENAME = re.compile(r'\..+\.[a-z0-9_]{8}\.tmp(\.[^.]*)?$')
+JOURNAL_FLUSH_SIZE = 100
+MANIFEST_FLUSH_SIZE = 1000
+PIPELINE_QUEUE_SIZE = 4
+STAGES = ['read', 'open', 'decode', 'convert', 'resize', 'mkdir', 'save']
+REPORT_SLOWEST = 10
+# rough seconds per megapixel on one core of a desktop CPU with Pillow 9, used by the cost estimate:
+# decoding per source megapixel, resizing per source megapixel and output,
+# color conversion per source megapixel and encoding per output megapixel.
+# They are relative weights, not calibrated to the machine, the backend or the content of the images.
+DECODE_COSTS = {'JPEG': 0.008, 'PNG': 0.04, 'TIFF': 0.003}
+RESIZE_COST = 0.015
+CONVERT_COST = 0.01
+ENCODE_COSTS = {'JPEG': 0.005, 'PNG': 0.5, 'WEBP': 0.18}
+DEFAULT_COST = 0.02
+
+EXECUTORS = {'process': ProcessPoolExecutor,
+             'thread': ThreadPoolExecutor}
+# libvips equivalents of the resample modes, color modes and encoder settings
+VIPS_KERNELS = {'none': 'nearest', 'bilinear': 'linear', 'bicubic': 'cubic',
+                'hamming': 'lanczos2', 'box': 'linear', 'antialias': 'lanczos3'}
+VIPS_INTERPRETATIONS = {'L': 'b-w', 'LA': 'b-w', 'RGB': 'srgb', 'RGBA': 'srgb', 'CMYK': 'cmyk'}
+VIPS_SUFFIXES = {'JPEG': '.jpg', 'PNG': '.png', 'WEBP': '.webp', 'TIFF': '.tif', 'GIF': '.gif'}
+VIPS_OPTIONS = {'JPEG': {'quality': 'Q', 'progressive': 'interlace', 'optimize': 'optimize_coding'},
+                'WEBP': {'quality': 'Q', 'method': 'effort', 'lossless': 'lossless'},
+                'PNG': {'compress_level': 'compression'}}
+
+# ways to create an output from an identical one
+DEDUPE_MODES = ['hardlink', 'reflink', 'copy']
+FICLONE = 0x40049409
 
 debug = logging.debug
 
+# the umask of the process, read once as it can only be read by setting it
+UMASK = umask(0)
+umask(UMASK)
+
 
 class CONSTANTS(type):
     pass
@@ -48,7 +133,23 @@ class CONFKEY(metaclass=CONSTANTS):
     SUBFOLDER = 'subfolder'
     WEBSET = 'webset'
     WEBSETADDON = 'websetaddon'
+    CASCADE, CASCADE_RATIO = 'cascade', 'cascade_ratio'
     MODE, COLORPROFILE = 'mode', 'colorprofile'
+    QUALITY, PROGRESSIVE, OPTIMIZE, SUBSAMPLING = 'quality', 'progressive', 'optimize', 'subsampling'
+    COMPRESSLEVEL, METHOD, LOSSLESS = 'compress_level', 'method', 'lossless'
+    MAXBYTES = 'max_bytes'
+
+
+# encoder settings supported per image format
+ENCODER_KEYS = {'JPEG': [CONFKEY.QUALITY, CONFKEY.PROGRESSIVE, CONFKEY.OPTIMIZE, CONFKEY.SUBSAMPLING],
+                'WEBP': [CONFKEY.QUALITY, CONFKEY.METHOD, CONFKEY.LOSSLESS],
+                'PNG': [CONFKEY.COMPRESSLEVEL, CONFKEY.OPTIMIZE]}
+
+# configuration keys which change the pixels or the encoding of an output
+RENDER_KEYS = [CONFKEY.WIDTH, CONFKEY.HEIGHT, CONFKEY.RESAMPLE, CONFKEY.FORMAT,
+               CONFKEY.MODE, CONFKEY.COLORPROFILE, CONFKEY.CASCADE, CONFKEY.CASCADE_RATIO,
+               CONFKEY.QUALITY, CONFKEY.PROGRESSIVE, CONFKEY.OPTIMIZE, CONFKEY.SUBSAMPLING,
+               CONFKEY.COMPRESSLEVEL, CONFKEY.METHOD, CONFKEY.LOSSLESS, CONFKEY.MAXBYTES]
 
 
 class OPTIONKEY(metaclass=CONSTANTS):
@@ -60,6 +161,22 @@ class OPTIONKEY(metaclass=CONSTANTS):
     PROJECTS, CONFIGS = 'projects', 'configs'
     NAME = 'name'
     PROJECT = 'project'
+    JOBS, EXECUTOR = 'jobs', 'executor'
+    FASTDECODE = 'fast_decode'
+    EMBEDDEDTHUMBNAIL = 'embedded_thumbnail'
+    STRICTCOLOR = 'strict_color'
+    MANIFEST = 'manifest'
+    HASHSOURCES = 'hash_sources'
+    RECURSIVE, INCLUDE, EXCLUDE = 'recursive', 'include', 'exclude'
+    REPORT = 'report'
+    EVENTS = 'events'
+    PIPELINE = 'pipeline'
+    MAXMEMORY = 'max_memory'
+    DEDUPE = 'dedupe'
+    SHARD = 'shard'
+    BACKEND = 'backend'
+    PILLOWONLY = 'pillow_only'
+    RESUME = 'resume'
 
 
 class Entries(object):
@@ -67,17 +184,16 @@ class Entries(object):
     def __init__(self, dict, defaults=None):
         self.dict = dict
         self.defaults = defaults
-        self.shown_messages = []
+        self.shown_messages = set()
 
     def _value(self, key, default, warning=False):
-        if key not in self.dict:
+        if key not in self.dict and key not in self.shown_messages:
+            self.shown_messages.add(key)
             msg = f"{self.__class__.__name__}: entry '{key}' not set. Using default value: {default}"
-            if msg not in self.shown_messages:
-                self.shown_messages.append(msg)
-                if warning:
-                    logging.warning(msg)
-                else:
-                    logging.debug(msg)
+            if warning:
+                logging.warning(msg)
+            else:
+                logging.debug(msg)
         if self.defaults is None:
             return self.dict.get(key, default)
         else:
@@ -117,6 +233,103 @@ class Entries(object):
     def debug(self):
         return self._value(OPTIONKEY.DEBUG, False)
 
+    @property
+    def jobs(self):
+        jobs = to_int_or_none(self._value(OPTIONKEY.JOBS, 1))
+        if jobs is None:
+            return 1
+        return jobs if jobs > 0 else cpu_count() or 1
+
+    @property
+    def executor(self):
+        executor = self._value(OPTIONKEY.EXECUTOR, 'process')
+        return executor if executor in EXECUTORS else 'process'
+
+    @property
+    def fast_decode(self):
+        return bool(self._value(OPTIONKEY.FASTDECODE, False))
+
+    @property
+    def embedded_thumbnail(self):
+        return bool(self._value(OPTIONKEY.EMBEDDEDTHUMBNAIL, False))
+
+    @property
+    def strict_color(self):
+        """if true, colors are always converted at the full resolution before resizing"""
+        return bool(self._value(OPTIONKEY.STRICTCOLOR, False))
+
+    @property
+    def manifest(self):
+        return bool(self._value(OPTIONKEY.MANIFEST, True))
+
+    @property
+    def hash_sources(self):
+        """if true, the manifest records the content hash of every source, so a
+        source with a new modification time but the same content is skipped"""
+        return bool(self._value(OPTIONKEY.HASHSOURCES, False))
+
+    @property
+    def recursive(self):
+        return bool(self._value(OPTIONKEY.RECURSIVE, False))
+
+    @property
+    def include(self):
+        return self._value(OPTIONKEY.INCLUDE, None) or SUPPORTED_FILES
+
+    @property
+    def exclude(self):
+        return self._value(OPTIONKEY.EXCLUDE, None) or []
+
+    @property
+    def pipeline(self):
+        return bool(self._value(OPTIONKEY.PIPELINE, False))
+
+    @property
+    def max_memory(self):
+        """memory budget in megabytes for the parallel workers or None"""
+        return to_int_or_none(self._value(OPTIONKEY.MAXMEMORY, None))
+
+    @property
+    def report(self):
+        return self._value(OPTIONKEY.REPORT, None)
+
+    @property
+    def events(self):
+        """file the JSON lines event stream is appended to or None"""
+        return self._value(OPTIONKEY.EVENTS, None)
+
+    @property
+    def backend(self):
+        """name of the image processing backend used, "pillow" or "vips". Pillow is
+        used instead of a backend, which is not available, and with the pipeline,
+        the server and the in-memory API, which support Pillow only. These set
+        the internal key 'pillow_only' to their name."""
+        backend = self._value(OPTIONKEY.BACKEND, 'pillow')
+        if backend == 'pillow' or backend not in BACKENDS:
+            return 'pillow'
+        pillow_only = self._value(OPTIONKEY.PILLOWONLY, None) or ('the pipeline' if self.pipeline else None)
+        if pillow_only:
+            _warn_backend(f"Backend '{backend}' is not supported by {pillow_only}, using Pillow instead")
+            return 'pillow'
+        return get_backend(backend).name
+
+    @property
+    def resume(self):
+        return bool(self._value(OPTIONKEY.RESUME, False))
+
+    @property
+    def shard(self):
+        """(index, count) of the shard processed by this run, the index from 1 to count, or None"""
+        return parse_shard(self._value(OPTIONKEY.SHARD, None))
+
+    @property
+    def dedupe(self):
+        """how outputs of identical sources are created, one of DEDUPE_MODES or None"""
+        dedupe = self._value(OPTIONKEY.DEDUPE, None)
+        if dedupe is True:
+            return 'copy'
+        return dedupe if dedupe in DEDUPE_MODES else None
+
     @property
     def project_name(self):
         return self._value(OPTIONKEY.NAME, '')
@@ -137,6 +350,26 @@ class Entries(object):
     def ext(self):
         return self._value(CONFKEY.FORMAT, 'jpg')
 
+    @property
+    def image_format(self):
+        """Pillow format name of the destination image"""
+        ext = str(self.ext).lower()
+        return IMAGE_FORMATS.get(ext) or Image.registered_extensions().get(f".{ext}")
+
+    @property
+    def encoder_options(self):
+        """the encoder settings set for the destination format as a tuple of (name, value) pairs"""
+        options = []
+        for key in ENCODER_KEYS.get(self.image_format, []):
+            value = self._value(key, None)
+            if value is not None:
+                options.append((key, value))
+        return tuple(options)
+
+    @property
+    def max_bytes(self):
+        return to_int_or_none(self._value(CONFKEY.MAXBYTES, None))
+
     @property
     def with_subfolder(self):
         return self._value(CONFKEY.SUBFOLDER, False)
@@ -154,6 +387,17 @@ class Entries(object):
     def color_profile(self):
         return self._value(CONFKEY.COLORPROFILE, None)
 
+    @property
+    def cascade(self):
+        return bool(self._value(CONFKEY.CASCADE, False))
+
+    @property
+    def cascade_ratio(self):
+        try:
+            return max(float(self._value(CONFKEY.CASCADE_RATIO, 1.5)), 1.0)
+        except (TypeError, ValueError):
+            return 1.5
+
     @property
     def resample(self):
         resample = self._value(CONFKEY.RESAMPLE, 'antialias')
@@ -164,7 +408,7 @@ class Entries(object):
 
     @property
     def resample_name(self):
-        return [key for key, value in RESAMPLE_MODES.items() if value == self.resample][0]
+        return RESAMPLE_NAMES[self.resample]
 
 
 class Args(Entries):
@@ -203,30 +447,253 @@ class Options(Entries):
     def get_projects(self):
         return self._value(OPTIONKEY.PROJECTS, None)
 
+    def print_plan(self):
+        for project in self.get_projects():
+            print(Project(project, defaults=self).plan)
+
+    def estimate(self):
+        """prints the estimated work and runtime of all projects without processing them"""
+        total = {}
+        for project in self.get_projects():
+            project = Project(project, defaults=self)
+            estimate = project.estimate()
+            print(f"project '{project.project_name}': {format_estimate(estimate)}")
+            for key, value in estimate.items():
+                total[key] = total.get(key, 0) + value
+        print(f"total: {format_estimate(total)}")
+        return total
+
+    def merge(self):
+        """merges the shard manifests of all projects and prints the outputs, which
+        are missing or were done twice. Returns True if there were none."""
+        complete = True
+        for project in self.get_projects():
+            project = Project(project, defaults=self)
+            merged = project.merge_shards()
+            if merged is None:
+                print(f"project '{project.project_name}': no shard manifests found")
+                complete = False
+                continue
+            missing, twice = merged
+            print(f"project '{project.project_name}': {len(missing)} missing, {len(twice)} done twice")
+            for output in missing:
+                print(f"  missing: {output}")
+            for output in twice:
+                print(f"  done twice: {output}")
+            complete = complete and not missing and not twice
+        return complete
+
     def exec(self):
         # TODO: Error if there is no project
         Out.init_image_bar(self.no_progress)
         Out.init_project_bar(self.no_progress)
-        for project in self.get_projects():
-            Project(project, defaults=self).exec()
+        color_transforms.clear()
+        created_folders.clear()
+        with self.instrumented():
+            for project in self.get_projects():
+                Project(project, defaults=self).exec()
+        logging.info(f"Color transform cache: {color_transforms.hits} hits, {color_transforms.misses} misses")
+
+    @contextmanager
+    def instrumented(self):
+        """registers the stage report and the event log of the options for a run"""
+        hooks = []
+        if self.report:
+            hooks.append(StageReport(self.report))
+        if self.events:
+            hooks.append(EventLog(self.events))
+        for hook in hooks:
+            instrumentation.add_hook(hook)
+        instrumentation.emit('run_started')
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            instrumentation.emit('run_finished', seconds=perf_counter() - start)
+            instrumentation.finish()
+            for hook in hooks:
+                instrumentation.remove_hook(hook)
 
 
 class Project(Entries):
 
+    def __init__(self, dict, defaults=None):
+        super().__init__(dict, defaults)
+        self._config_entries = None
+        self._plan = None
+
     def exec(self):
-        configs = self._process_configs(self._get_configs())
-        filenames = self._file_names()
-        Out.project_bar.reset(total=len(filenames))
+        filenames = self._counted(self._file_names())
+        Out.project_bar.reset(total=0)
 
         Out.out(f"Processing project '{self.project_name}':")
+        self.process(filenames)
 
-        for filename in filenames:
+    @property
+    def config_entries(self):
+        """the config entries with resolved websets. They are created once per project."""
+        if self._config_entries is None:
             # TODO: Error if there is no config entry
-            Out.image_bar.reset(total=len(configs))
-            for config in configs:
-                CurrentImage(filename, ConfigEntry(config, defaults=self)).generate()
-                Out.image_bar.update()
-            Out.project_bar.update()
+            configs = self._process_configs(self._get_configs())
+            self._config_entries = [ConfigEntry(config, defaults=self) for config in configs]
+        return self._config_entries
+
+    @property
+    def plan(self):
+        """the frozen execution plan of the project. It is compiled once per project."""
+        if self._plan is None:
+            self._plan = ProjectPlan(self)
+        return self._plan
+
+    def open_manifest(self):
+        """opens the manifest of the destination folder. Sharded runs always
+        record their outputs, in a manifest file of their own."""
+        return Manifest(self.plan.dest, enabled=self.plan.manifest or self.plan.shard is not None, shard=self.plan.shard,
+                        hash_sources=self.plan.hash_sources)
+
+    def merge_shards(self):
+        """merges the shard manifests of the destination folder into its manifest.
+
+        Returns the outputs, which are not current after the merge, and the
+        outputs recorded by more than one shard. The shard manifests are only
+        merged and removed if both are empty. Returns None without touching
+        the manifest if there are no shard manifests.
+        """
+        names = listdir(self.plan.dest) if exists(self.plan.dest) else []
+        shard_filenames = sorted(join(self.plan.dest, name) for name in names
+                                 if fnmatchcase(name, SHARD_MANIFEST_FILENAME.format(index='*', count='*')))
+        if not shard_filenames:
+            logging.warning(f"No shard manifests found in {self.plan.dest}")
+            return None
+        manifest = Manifest(self.plan.dest)
+        shards = {}
+        for shard_filename in shard_filenames:
+            entries = list(read_manifest(shard_filename))
+            for entry in entries:
+                shards.setdefault(entry['output'], set()).add(shard_filename)
+            manifest.merge(entries)
+        twice = sorted(output for output, recorded_by in shards.items() if len(recorded_by) > 1)
+        missing = []
+        for filename in self._file_names():
+            for output in self.plan.outputs:
+                current_image = CurrentImage(filename, output)
+                if not manifest.is_current(current_image):
+                    missing.append(manifest.key(current_image))
+        if not missing and not twice:
+            manifest.flush()
+            manifest.compact()
+            for shard_filename in shard_filenames:
+                remove(shard_filename)
+        logging.info(f"Merged {len(shard_filenames)} shard manifest(s) of {self.plan.dest}: "
+                     f"{len(shards)} output(s), {len(missing)} missing, {len(twice)} done twice")
+        return missing, twice
+
+    def process(self, filenames, manifest=None):
+        """generates the outdated outputs of `filenames`. Without `manifest` the
+        manifest of the destination folder is opened for this call."""
+        if manifest is None:
+            with self.open_manifest() as manifest:
+                return self.process(filenames, manifest)
+        deduplicator = Deduplicator(manifest, self.plan.dedupe) if self.plan.dedupe else None
+        metadata = MetadataIndex(self.plan.dest) if self.plan.max_memory else nullcontext()
+        with metadata, Journal(self.plan.dest, resume=self.plan.resume, shard=self.plan.shard) as journal, \
+                Executor.create(self.plan.jobs, self.plan.executor, self.plan.pipeline, self.plan.max_memory,
+                                metadata if self.plan.max_memory else None) as executor:
+            work = self._outdated(filenames, self.plan.outputs, manifest, journal)
+            if deduplicator is not None:
+                work = deduplicator.originals(work)
+            started = {}
+            try:
+                for filename, rendered, events in executor.run(
+                        work, self._report, instrumentation.enabled,
+                        partial(self._started, started) if instrumentation.enabled else None):
+                    manifest.record(filename, rendered)
+                    journal.record(filename, rendered)
+                    instrumentation.record(events)
+                    self._finished(filename, rendered, started)
+                    Out.project_bar.update()
+            except Exception as error:
+                instrumentation.emit('error', project=self.plan.project_name,
+                                     source=getattr(error, 'source_filename', None),
+                                     error=f"{type(error).__name__}: {error}")
+                raise
+            if deduplicator is not None:
+                for filename, outdated in deduplicator.duplicates:
+                    reused = deduplicator.reuse(filename, outdated, self._report)
+                    manifest.record(filename, reused)
+                    journal.record(filename, reused)
+                    self._finished(filename, reused, started)
+                    Out.project_bar.update()
+                deduplicator.report()
+        manifest.flush()
+
+    def _outdated(self, filenames, config_entries, manifest, journal=None, quiet=False, adopt=True):
+        """yields the source files with the config entries whose outputs need to be generated.
+        Outputs done according to the resumed `journal` are skipped without further checks.
+        Without `adopt` the manifest is only read, see `Manifest.is_current`."""
+        for filename in filenames:
+            outdated = []
+            for config_entry in config_entries:
+                if journal is not None and journal.is_done(filename, config_entry):
+                    continue
+                current_image = CurrentImage(filename, config_entry)
+                if not config_entry.override and manifest.is_current(current_image, adopt):
+                    if not quiet:
+                        Out.out(f"ignore file: {current_image.destination_filename}")
+                else:
+                    outdated.append(config_entry)
+            if outdated:
+                yield filename, outdated
+            elif not quiet:
+                instrumentation.emit('skipped', project=self.plan.project_name, source=filename)
+                Out.project_bar.update()
+
+    def _started(self, started, filename, config_entries):
+        """emits the started event of a source file, called by the executor when its processing starts"""
+        started[filename] = perf_counter()
+        instrumentation.emit('started', project=self.plan.project_name, source=filename,
+                             outputs=len(config_entries))
+
+    def _finished(self, filename, config_entries, started):
+        if instrumentation.enabled:
+            start = started.pop(filename, None)
+            instrumentation.emit('finished', project=self.plan.project_name, source=filename,
+                                 outputs=[CurrentImage(filename, config_entry).destination_filename
+                                          for config_entry in config_entries],
+                                 seconds=None if start is None else perf_counter() - start)
+
+    def estimate(self):
+        """estimates the outdated outputs of the project from the source headers
+        without processing them. Returns a dict with the number of sources and
+        outputs, the input and output megapixels and the runtime in seconds."""
+        estimate = {'sources': 0, 'outputs': 0, 'unreadable': 0, 'input_mp': 0.0, 'output_mp': 0.0, 'seconds': 0.0}
+        with MetadataIndex(self.plan.dest) as metadata:
+            manifest = Manifest(self.plan.dest, enabled=self.plan.manifest, shard=self.plan.shard)
+            for filename, config_entries in self._outdated(self._file_names(), self.plan.outputs, manifest,
+                                                           quiet=True, adopt=False):
+                header = metadata.get(filename)
+                if header is None:
+                    estimate['unreadable'] += 1
+                    continue
+                input_mp, output_mp, seconds = estimate_cost(header, config_entries)
+                estimate['sources'] += 1
+                estimate['outputs'] += len(config_entries)
+                estimate['input_mp'] += input_mp
+                estimate['output_mp'] += output_mp
+                estimate['seconds'] += seconds
+        estimate['seconds'] /= self.plan.jobs
+        return estimate
+
+    def _counted(self, filenames):
+        """passes the file names through and updates the total of the progress bar on discovery"""
+        for filename in filenames:
+            Out.project_bar.total += 1
+            Out.project_bar.refresh()
+            yield filename
+
+    def _report(self, message):
+        Out.out(message)
+        Out.image_bar.update()
 
     def _get_configs(self):
         return self._value(OPTIONKEY.CONFIGS, None)
@@ -239,10 +706,9 @@ class Project(Entries):
                 configs.extend(self._create_webset_entries(entry))
             else:
                 configs.append(entry)
-        debug("raw config:")
-        logging.debug(pformat(raw_config))
-        logging.debug("solved config:")
-        logging.debug(pformat(configs))
+        if logging.root.isEnabledFor(logging.DEBUG):
+            logging.debug("raw config:\n%s", pformat(raw_config))
+            logging.debug("solved config:\n%s", pformat(configs))
         return configs
 
     def _create_webset_entries(self, entry):
@@ -259,31 +725,782 @@ class Project(Entries):
             print("ERROR")
         return configs
 
-    def _file_names(self, supported_files=SUPPORTED_FILES):
-        return [abspath(file) for ext in supported_files for file in glob(join(self.source, ext))]
+    def _file_names(self, supported_files=None):
+        filenames = scan_files(self.source,
+                               include=supported_files or self.include,
+                               exclude=self.exclude,
+                               recursive=self.recursive,
+                               skip_folders=[self.dest])
+        if self.shard is None:
+            return filenames
+        index, count = self.shard
+        source = abspath(self.source)
+        return (filename for filename in filenames if shard_index(relpath(filename, source), count) == index - 1)
 
 
 class ConfigEntry(Entries):
-    pass
+
+    @property
+    def name_prefix(self):
+        """part of the destination file name in front of the source name"""
+        return self.prefix
+
+    @property
+    def name_suffix(self):
+        """part of the destination file name after the source name"""
+        return f"{self.suffix}{self.websetaddon}.{self.ext}"
+
+    @property
+    def label(self):
+        """short description of the config entry by its destination file names"""
+        return f"{self.name_prefix}*{self.name_suffix}"
+
+    @property
+    def config_name(self):
+        """name of the config entry, e.g. in the URLs of the server. It is set by
+        the 'name' key of the config, else the destination file name without the
+        source name is used."""
+        name = self.dict.get(OPTIONKEY.NAME)
+        if name:
+            return f"{name}{self.websetaddon}"
+        return f"{self.name_prefix}{self.name_suffix}"
+
+    @property
+    def config_hash(self):
+        """hash of all resolved settings, which change the pixels or the encoding of the output"""
+        settings = {key: self._value(key, None) for key in RENDER_KEYS}
+        settings[OPTIONKEY.FASTDECODE] = self.fast_decode
+        if self.embedded_thumbnail:
+            settings[OPTIONKEY.EMBEDDEDTHUMBNAIL] = True
+        if self.strict_color:
+            settings[OPTIONKEY.STRICTCOLOR] = True
+        if self.backend != 'pillow':
+            settings[OPTIONKEY.BACKEND] = self.backend
+        return hashlib.sha1(json.dumps(settings, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class Plan(object):
+    """Immutable record of resolved settings.
+
+    The values are resolved once from an `Entries` hierarchy, so reading them
+    in the processing loop is a plain attribute access instead of a lookup
+    through the defaults chain.
+    """
+
+    __slots__ = ()
+
+    def __init__(self, **values):
+        for name in self.__slots__:
+            object.__setattr__(self, name, values[name])
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"{self.__class__.__name__} is immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError(f"{self.__class__.__name__} is immutable")
+
+    def __getstate__(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __setstate__(self, state):
+        for name, value in zip(self.__slots__, state):
+            object.__setattr__(self, name, value)
+
+    def __repr__(self):
+        values = ', '.join(f"{name}={getattr(self, name)!r}" for name in self.__slots__)
+        return f"{self.__class__.__name__}({values})"
+
+
+class OutputPlan(Plan):
+    """Resolved settings of one config entry after webset expansion.
+
+    It provides the same attributes as `ConfigEntry`, so it can be used
+    wherever a config entry is expected.
+    """
+
+    __slots__ = ('source', 'dest', 'override', 'prefix', 'suffix', 'websetaddon', 'ext', 'with_subfolder',
+                 'destination_size', 'mode', 'color_profile', 'resample', 'resample_name',
+                 'cascade', 'cascade_ratio', 'fast_decode', 'embedded_thumbnail', 'strict_color', 'backend', 'dedupe', 'label', 'config_name', 'config_hash',
+                 'name_prefix', 'name_suffix', 'image_format', 'encoder_options', 'max_bytes')
+
+    def __init__(self, config_entry):
+        values = {name: getattr(config_entry, name) for name in self.__slots__}
+        values['source'] = abspath(values['source'])
+        super().__init__(**values)
+
+    def __str__(self):
+        size = self.destination_size
+        return (f"{self.label}: size {size.width or 'auto'}x{size.height or 'auto'}, mode {self.mode}, "
+                f"profile {self.color_profile or 'sRGB'}, resample {self.resample_name}"
+                f"{''.join(f', {key} {value}' for key, value in self.encoder_options)}"
+                f"{f', max bytes {self.max_bytes}' if self.max_bytes else ''}"
+                f"{', cascade' if self.cascade else ''}{', fast decode' if self.fast_decode else ''}"
+                f"{', embedded thumbnail' if self.embedded_thumbnail else ''}{', strict color' if self.strict_color else ''}"
+                f"{f', backend {self.backend}' if self.backend != 'pillow' else ''}")
+
+
+class ProjectPlan(Plan):
+    """Resolved settings of a project and the output plans of its config entries."""
+
+    __slots__ = ('project_name', 'source', 'dest', 'jobs', 'executor', 'pipeline', 'max_memory', 'manifest',
+                 'hash_sources', 'dedupe', 'shard', 'resume', 'recursive', 'include', 'exclude', 'outputs')
+
+    def __init__(self, project):
+        values = {name: getattr(project, name) for name in self.__slots__[:-1]}
+        values['include'] = tuple(values['include'])
+        values['exclude'] = tuple(values['exclude'])
+        values['outputs'] = tuple(OutputPlan(config_entry) for config_entry in project.config_entries)
+        super().__init__(**values)
+
+    def __str__(self):
+        lines = [f"project '{self.project_name}': {self.source} -> {self.dest}",
+                 f"  jobs {self.jobs} ({'pipeline' if self.pipeline else self.executor}), "
+                 f"max memory {self.max_memory or 'unlimited'}, manifest {self.manifest}"
+                 f"{' with source hashes' if self.hash_sources else ''}, recursive {self.recursive}, "
+                 f"dedupe {self.dedupe or 'off'}, shard {'{}/{}'.format(*self.shard) if self.shard else 'all'}",
+                 f"  include {', '.join(self.include)}" + (f", exclude {', '.join(self.exclude)}" if self.exclude else '')]
+        lines.extend(f"  {output}" for output in self.outputs)
+        return '\n'.join(lines)
+
+
+def process_source(filename, config_entries, report=None, timed=False):
+    """generates all outputs of one source file from a single decode.
+
+    Existing outputs are overridden, the caller decides which outputs are
+    outdated. The messages are passed to `report` as soon as an output is
+    done. Without `report` (e.g. in a worker process) they are returned to the
+    caller. Returns the messages and, if `timed`, the stage events.
+    """
+    messages = []
+    timer = StageTimer(filename) if timed else NULL_TIMER
+    backend = get_backend(config_entries[0].backend if config_entries else 'pillow')
+    try:
+        backend.process_source(filename, config_entries, report or messages.append, timer)
+    except Exception as error:
+        # names the source in the error event, it survives the transfer from a worker process
+        error.source_filename = filename
+        raise
+    return messages, timer.events
+
+
+def process_in_worker(filename, config_entries, timed=False):
+    """runs `process_source` in a worker process. Returns the messages, the
+    stage events and the (hits, misses) of its color transform cache, which
+    are added to the cache counters of the main process."""
+    hits, misses = color_transforms.hits, color_transforms.misses
+    messages, events = process_source(filename, config_entries, None, timed)
+    return messages, events, (color_transforms.hits - hits, color_transforms.misses - misses)
+
+
+class Executor(object):
+    """Runs `process_source` for every (source file, config entries) work item
+    in the current process. `run` yields the work items when they are done and
+    calls `started`, if given, with each work item when its processing starts."""
+
+    def __init__(self, jobs=1):
+        self.jobs = jobs
+
+    @staticmethod
+    def create(jobs, kind='process', pipeline=False, max_memory=None, metadata=None):
+        if pipeline:
+            return PipelineExecutor(jobs)
+        if jobs <= 1:
+            return Executor()
+        return PoolExecutor(jobs, kind, max_memory, metadata)
+
+    def run(self, work, report, timed=False, started=None):
+        for filename, config_entries in work:
+            if started is not None:
+                started(filename, config_entries)
+            Out.image_bar.reset(total=len(config_entries))
+            _, events = process_source(filename, config_entries, report, timed)
+            yield filename, config_entries, events
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+class PoolExecutor(Executor):
+    """Distributes the source files over a process or thread pool.
+
+    Every source file is one task, so a source is still decoded once. At most
+    two tasks per worker are pending at a time to bound the memory and to
+    report progress early, and a task starts soon after it is submitted. With
+    `max_memory` (megabytes) the tasks are admitted by a `MemoryScheduler`,
+    which takes the source sizes from the `metadata` index if given.
+    """
+
+    def __init__(self, jobs, kind='process', max_memory=None, metadata=None):
+        super().__init__(jobs)
+        self.kind = kind
+        self.max_memory = max_memory
+        self.metadata = metadata
+        self.pool = EXECUTORS[kind](max_workers=jobs)
+        logging.debug(f"Using {jobs} {kind} workers")
+
+    def run(self, work, report, timed=False, started=None):
+        pending = {}
+        scheduler = MemoryScheduler(work, self.max_memory * 1024 * 1024, self.metadata) if self.max_memory else None
+        work = ((filename, config_entries, 0) for filename, config_entries in work)
+        while True:
+            admitted = work if scheduler is None else scheduler.admit(lambda: len(pending))
+            for filename, config_entries, estimate in admitted:
+                if started is not None:
+                    started(filename, config_entries)
+                if self.kind == 'process':
+                    future = self.pool.submit(process_in_worker, filename, config_entries, timed)
+                else:
+                    future = self.pool.submit(process_source, filename, config_entries, None, timed)
+                pending[future] = (filename, config_entries, estimate)
+                if len(pending) >= self.jobs * 2:
+                    break
+            if not pending:
+                return
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                filename, config_entries, estimate = pending.pop(future)
+                if scheduler is not None:
+                    scheduler.release(estimate)
+                Out.image_bar.reset(total=len(config_entries))
+                messages, events, *counts = future.result()
+                if counts:
+                    color_transforms.add_counts(*counts[0])
+                for message in messages:
+                    report(message)
+                yield filename, config_entries, events
+
+    def __exit__(self, *args):
+        self.pool.shutdown(wait=True)
+
+
+class MemoryScheduler(object):
+    """Orders the work items largest first and admits them under a memory budget.
+
+    The decode memory of every source file is estimated from its header, so
+    no pixels are loaded for scheduling. An item is admitted when it fits
+    into the remaining budget. Items larger than the whole budget are only
+    admitted when nothing else runs, so they run alone. As all items are
+    estimated up front, the source discovery completes before processing
+    starts.
+    """
+
+    def __init__(self, work, max_bytes, metadata=None):
+        self.max_bytes = max_bytes
+        self.in_use = 0
+        self.pending = [(estimate_memory(filename, config_entries, metadata), filename, config_entries)
+                        for filename, config_entries in work]
+        self.pending.sort(key=lambda item: item[0], reverse=True)
+        logging.debug(f"Scheduling {len(self.pending)} sources, estimated "
+                      f"{sum(item[0] for item in self.pending) / 1024 / 1024:.0f} MB")
+
+    def admit(self, running):
+        """yields (filename, config_entries, estimate) items as long as they fit.
+        `running` returns the number of running items. When nothing fits, the
+        generator ends, the next admission round needs a new generator."""
+        while self.pending:
+            if running() == 0:
+                index = 0
+            else:
+                index = next((index for index, item in enumerate(self.pending)
+                              if self.in_use + item[0] <= self.max_bytes), None)
+            if index is None:
+                return
+            estimate, filename, config_entries = self.pending.pop(index)
+            self.in_use += estimate
+            yield filename, config_entries, estimate
+
+    def release(self, estimate):
+        self.in_use -= estimate
+
+
+def format_estimate(estimate):
+    minutes, seconds = divmod(round(estimate.get('seconds', 0)), 60)
+    text = (f"{estimate.get('sources', 0)} source(s) with {estimate.get('input_mp', 0):.1f} MP, "
+            f"{estimate.get('outputs', 0)} output(s) with {estimate.get('output_mp', 0):.1f} MP, "
+            f"estimated {minutes // 60}:{minutes % 60:02d}:{seconds:02d}")
+    if estimate.get('unreadable'):
+        text += f", {estimate['unreadable']} unreadable source(s)"
+    return text
+
+
+def read_header(filename):
+    """returns size, mode, format and ICC profile presence of an image file from
+    its header without decoding the pixels, or None if it cannot be read"""
+    try:
+        with Image.open(filename) as image:
+            return {'width': image.size[0], 'height': image.size[1], 'mode': image.mode,
+                    'format': image.format, 'icc': bool(image.info.get('icc_profile'))}
+    except OSError:
+        return None
+
+
+def estimate_cost(header, config_entries):
+    """estimates (input megapixels, output megapixels, seconds) of processing a
+    source file with the `header` from `read_header` for `config_entries`.
+    The seconds are a rough guess from the fixed `DECODE_COSTS` etc."""
+    source_size = Size((header['width'], header['height']))
+    input_mp = header['width'] * header['height'] / 1e6
+    seconds = input_mp * DECODE_COSTS.get(header['format'], DEFAULT_COST)
+    if header['icc'] or any(config_entry.mode != header['mode'] for config_entry in config_entries):
+        seconds += input_mp * CONVERT_COST
+    output_mp = 0
+    for config_entry in config_entries:
+        destination_size = source_size.destination_size(config_entry.destination_size)
+        mp = destination_size.width * destination_size.height / 1e6
+        output_mp += mp
+        seconds += input_mp * RESIZE_COST + mp * ENCODE_COSTS.get(config_entry.image_format, DEFAULT_COST)
+    return input_mp, output_mp, seconds
+
+
+def pixel_bytes(mode):
+    """bytes per pixel of the Pillow memory layout of `mode`"""
+    if mode in ('1', 'L', 'P'):
+        return 1
+    if mode.startswith('I;16'):
+        return 2
+    return 4
+
+
+def estimate_memory(filename, config_entries, metadata=None):
+    """estimates the peak memory of processing a source file from its header:
+    the decoded source, its converted copy and the outputs kept at a time.
+    The header is taken from the `metadata` index if given."""
+    header = metadata.get(filename) if metadata is not None else read_header(filename)
+    if header is None:
+        return 0
+    size, mode = (header['width'], header['height']), header['mode']
+    source_size = Size(size)
+    estimate = size[0] * size[1] * pixel_bytes(mode)
+    modes = {config_entry.mode for config_entry in config_entries}
+    if modes - {mode}:
+        estimate += size[0] * size[1] * max(pixel_bytes(destination_mode) for destination_mode in modes)
+    outputs = []
+    for config_entry in config_entries:
+        destination_size = source_size.destination_size(config_entry.destination_size)
+        outputs.append(destination_size.width * destination_size.height * pixel_bytes(config_entry.mode))
+    if outputs:
+        cascade = any(config_entry.cascade for config_entry in config_entries)
+        estimate += sum(outputs) if cascade else max(outputs)
+    return estimate
+
+
+class PipelineExecutor(Executor):
+    """Overlaps reading, processing and writing in a staged pipeline.
+
+    A reader thread prefetches the raw bytes of the source files, `jobs`
+    threads decode, convert and resize them and a writer thread encodes and
+    writes the outputs. The stages are connected by bounded queues, so a fast
+    stage blocks instead of filling the memory, and the throughput approaches
+    the one of the slowest stage. The work items are taken from `work` by the
+    calling thread, which hands only the file names to the reader, so the
+    outdated checks and the manifest stay on the calling thread. Messages and
+    progress are still reported by the calling thread.
+    """
+
+    _DONE = object()
+    _STARTED = object()
+
+    def __init__(self, jobs=1, queue_size=PIPELINE_QUEUE_SIZE):
+        super().__init__(jobs)
+        self.queue_size = queue_size
+
+    def run(self, work, report, timed=False, started=None):
+        file_queue = queue.Queue()
+        read_queue = queue.Queue(self.queue_size)
+        write_queue = queue.Queue(self.queue_size)
+        done_queue = queue.Queue()
+        stop = threading.Event()
+
+        def put(target, item):
+            while not stop.is_set():
+                try:
+                    target.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    pass
+
+        def get(source, default):
+            while not stop.is_set():
+                try:
+                    return source.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            return default
+
+        def read():
+            filename = None
+            try:
+                while True:
+                    item = get(file_queue, self._DONE)
+                    if item is self._DONE:
+                        break
+                    filename, config_entries = item
+                    done_queue.put((self._STARTED, filename, config_entries))
+                    timer = StageTimer(filename) if timed else NULL_TIMER
+                    with timer.stage('read'):
+                        with open(filename, 'rb') as source_file:
+                            data = source_file.read()
+                    put(read_queue, (filename, config_entries, data, timer))
+            except BaseException as error:
+                if filename is not None:
+                    error.source_filename = filename
+                done_queue.put(error)
+            finally:
+                for _ in range(self.jobs):
+                    put(read_queue, self._DONE)
+
+        def process():
+            filename = None
+            try:
+                while True:
+                    item = get(read_queue, self._DONE)
+                    if item is self._DONE:
+                        break
+                    filename, config_entries, data, timer = item
+                    with SourceImage(filename, timer, data=data) as source_image:
+                        for current_image in source_image.prepare(config_entries):
+                            image = None if current_image.same_as is not None else current_image.render()
+                            put(write_queue, (current_image, image))
+                    put(write_queue, (self._DONE, (filename, config_entries, timer)))
+            except BaseException as error:
+                if filename is not None:
+                    error.source_filename = filename
+                done_queue.put(error)
+            finally:
+                put(write_queue, (None, None))
+
+        def write():
+            running = self.jobs
+            current_image = None
+            try:
+                while running and not stop.is_set():
+                    current_image, image = get(write_queue, (None, None))
+                    if current_image is None:
+                        running -= 1
+                    elif current_image is self._DONE:
+                        done_queue.put(image)
+                    else:
+                        done_queue.put(current_image.save(image))
+            except BaseException as error:
+                if current_image not in (None, self._DONE):
+                    error.source_filename = current_image.source_filename
+                done_queue.put(error)
+            finally:
+                done_queue.put(None)
+
+        threads = [threading.Thread(target=read, daemon=True),
+                   threading.Thread(target=write, daemon=True)]
+        threads.extend(threading.Thread(target=process, daemon=True) for _ in range(self.jobs))
+        for thread in threads:
+            thread.start()
+        work = iter(work)
+        # work items handed to the reader and not done yet, enough to keep all stages busy
+        max_pending = self.jobs + 2 * self.queue_size
+        pending = 0
+        try:
+            while True:
+                while work is not None and pending < max_pending:
+                    item = next(work, None)
+                    if item is None:
+                        work = None
+                        file_queue.put(self._DONE)
+                    else:
+                        file_queue.put(item)
+                        pending += 1
+                item = done_queue.get()
+                if item is None:
+                    return
+                if isinstance(item, BaseException):
+                    raise item
+                if isinstance(item, str):
+                    report(item)
+                elif item[0] is self._STARTED:
+                    if started is not None:
+                        started(*item[1:])
+                else:
+                    filename, config_entries, timer = item
+                    pending -= 1
+                    Out.image_bar.reset(total=len(config_entries))
+                    yield filename, config_entries, timer.events
+        finally:
+            stop.set()
+
+
+class SourceImage(object):
+    """Decoded source image shared by all configs of one source file.
+
+    The source is read from `source_filename` or, if given, from `data`,
+    either the bytes of the file or a file-like object.
+
+    The file is opened and decoded on first use only, so a source whose outputs
+    are all skipped is never read. The converted image of the most recent
+    conversion is kept, which bounds the memory to the decoded source plus one
+    converted copy. With cascaded resizing the resized outputs of that
+    conversion are kept additionally as intermediates for smaller outputs.
+    """
+
+    def __init__(self, source_filename, timer=None, data=None):
+        self.source_filename = source_filename
+        self.timer = timer if timer is not None else NULL_TIMER
+        self.data = data
+        self._image = None
+        self._size = None
+        self._reduce = 1
+        self._loaded = False
+        self._converted_key = None
+        self._converted = None
+        self._intermediates = []
+
+    def _open(self):
+        if self._image is None:
+            if self.data is None:
+                source = self.source_filename
+            elif isinstance(self.data, (bytes, bytearray, memoryview)):
+                source = io.BytesIO(self.data)
+            else:
+                source = self.data
+            with self.timer.stage('open'):
+                self._image = Image.open(source)
+            self._size = self._image.size
+        return self._image
+
+    @property
+    def size(self):
+        """original size of the source image, read from the header without decoding"""
+        self._open()
+        return self._size
+
+    @property
+    def image(self):
+        if not self._loaded:
+            logging.debug("Decoding %s", self.source_filename)
+            image = self._open()
+            with self.timer.stage('decode'):
+                image.load()
+                if self._reduce > 1:
+                    logging.debug("Reducing %s by %s", self.source_filename, self._reduce)
+                    self._image = image.reduce(self._reduce)
+                    image.close()
+            self._loaded = True
+        return self._image
+
+    def prepare(self, config_entries):
+        """returns the `CurrentImage` of every config entry in processing order
+        and sets up the decoding for them"""
+        if any(config_entry.cascade for config_entry in config_entries):
+            config_entries = self.cascade_order(config_entries)
+        thumbnail = (all(config_entry.embedded_thumbnail for config_entry in config_entries)
+                     and self.embedded_thumbnail(config_entries))
+        if not thumbnail and all(config_entry.fast_decode for config_entry in config_entries):
+            self.fast_decode(config_entries)
+        current_images = self.group_conversions(
+            [CurrentImage(self.source_filename, config_entry, self) for config_entry in config_entries])
+        self.collapse(current_images)
+        self.order_stages(current_images)
+        return current_images
+
+    @staticmethod
+    def group_conversions(current_images):
+        """sorts the outputs by their conversion target in the order of their first
+        appearance, so outputs with the same target share one converted source"""
+        groups = OrderedDict()
+        for current_image in current_images:
+            groups.setdefault(current_image.conversion_key, []).append(current_image)
+        return [current_image for group in groups.values() for current_image in group]
+
+    def order_stages(self, current_images):
+        """chooses for every conversion target, whether its outputs are resized
+        before the color conversion.
+
+        Resizing first converts only the pixels of the outputs instead of all
+        pixels of the source. It is chosen for downscaled outputs, if the color
+        conversion works per pixel (see RESIZE_FIRST_SOURCES and
+        RESIZE_FIRST_TARGETS) and all outputs of the target have fewer pixels
+        than the source, which is otherwise converted once for all of them.
+        Outputs with strict_color or cascade keep converting first.
+        """
+        source_size = Size(self.size)
+        source_pixels = source_size.width * source_size.height
+        source_mode = self._open().mode
+        groups = OrderedDict()
+        for current_image in current_images:
+            config_entry = current_image.config_entry
+            if (current_image.same_as is not None or config_entry.strict_color or config_entry.cascade
+                    or config_entry.mode == source_mode or source_mode not in RESIZE_FIRST_SOURCES
+                    or config_entry.mode not in RESIZE_FIRST_TARGETS):
+                continue
+            size = source_size.destination_size(config_entry.destination_size)
+            if size.width * size.height < source_pixels:
+                groups.setdefault(current_image.conversion_key, []).append((current_image, size.width * size.height))
+        for group in groups.values():
+            if sum(pixels for _, pixels in group) < source_pixels:
+                for current_image, _ in group:
+                    current_image.resize_first = True
+
+    @staticmethod
+    def collapse(current_images):
+        """links every output to the first output with the same render key, e.g.
+        {"width": 400} and the @2x output of {"width": 200, "webset": "@2x"}.
+        Only the first one is rendered and encoded."""
+        first = {}
+        for current_image in current_images:
+            same_as = first.setdefault(current_image.render_key, current_image)
+            if same_as is not current_image:
+                logging.debug("%s is the same as %s", current_image.destination_filename_short, same_as.destination_filename_short)
+                current_image.same_as = same_as
+
+    def fast_decode(self, config_entries, headroom=FAST_DECODE_HEADROOM):
+        """decodes the source at a reduced scale, if all outputs are much smaller.
+
+        JPEG files are decoded by the DCT scaling of the decoder (draft mode),
+        other formats are reduced by an integer factor right after decoding,
+        if their mode is one of `REDUCE_MODES`. The decoded image stays at least `headroom` times larger than the
+        largest output, so the final resize keeps its quality.
+        """
+        if self._loaded:
+            return
+        source_size = Size(self.size)
+        sizes = [source_size.destination_size(config_entry.destination_size) for config_entry in config_entries]
+        if not sizes:
+            return
+        requested = (max(size.width for size in sizes) * headroom, max(size.height for size in sizes) * headroom)
+        factor = min(source_size.width // max(requested[0], 1), source_size.height // max(requested[1], 1))
+        if factor < 2:
+            return
+        image = self._open()
+        if image.format == 'JPEG':
+            logging.debug("Draft decoding %s for %s", self.source_filename, requested)
+            image.draft(image.mode, requested)
+        elif hasattr(image, 'reduce') and image.mode in REDUCE_MODES:
+            self._reduce = factor
+
+    def embedded_thumbnail(self, config_entries, tolerance=EMBEDDED_THUMBNAIL_TOLERANCE):
+        """decodes the JPEG thumbnail embedded in the EXIF data instead of the
+        source, if it is at least as large as all outputs. Returns True if the
+        thumbnail is used.
+
+        The thumbnail must have the color mode of the source and its aspect
+        ratio within `tolerance`, so letterboxed previews are not used. The
+        ICC profile of the source is applied to the thumbnail. If the
+        thumbnail is missing, too small or cannot be decoded, the source is
+        decoded as usual.
+        """
+        if self._loaded or not config_entries:
+            return False
+        image = self._open()
+        data = exif_thumbnail(image.info.get('exif'))
+        if data is None:
+            return False
+        source_size = Size(self.size)
+        sizes = [source_size.destination_size(config_entry.destination_size) for config_entry in config_entries]
+        try:
+            with self.timer.stage('decode'):
+                thumbnail = Image.open(io.BytesIO(data))
+                if (thumbnail.mode != image.mode
+                        or abs(thumbnail.width * source_size.height / (thumbnail.height * source_size.width) - 1) > tolerance
+                        or any(size.width > thumbnail.width or size.height > thumbnail.height for size in sizes)):
+                    return False
+                thumbnail.load()
+        except (OSError, SyntaxError, ZeroDivisionError) as error:
+            logging.debug("Cannot use the embedded thumbnail of %s: %s", self.source_filename, error)
+            return False
+        logging.debug("Using the embedded thumbnail %s of %s", thumbnail.size, self.source_filename)
+        if image.info.get('icc_profile'):
+            thumbnail.info['icc_profile'] = image.info['icc_profile']
+        image.close()
+        self._image = thumbnail
+        self._loaded = True
+        return True
+
+    def converted(self, key, convert):
+        """returns the source image converted by `convert`. The result is cached for `key`."""
+        if key != self._converted_key:
+            self._converted = None
+            self._intermediates = []
+            image = self.image
+            with self.timer.stage('convert'):
+                self._converted = convert(image)
+            self._converted_key = key
+        return self._converted
+
+    def cascade_order(self, config_entries):
+        """sorts the config entries by their destination size, largest first, so
+        smaller outputs can be derived from larger ones"""
+        source_size = Size(self.size)
+
+        def area(config_entry):
+            size = source_size.destination_size(config_entry.destination_size)
+            return size.width * size.height
+
+        return sorted(config_entries, key=lambda config_entry: (config_entry.mode,
+                                                                str(config_entry.color_profile),
+                                                                -area(config_entry)))
+
+    def resize_base(self, size, min_ratio):
+        """returns the smallest intermediate, which is at least `min_ratio` times
+        larger than `size` and has the same aspect ratio. Defaults to the
+        converted source image."""
+        candidates = [image for image in self._intermediates
+                      if image.width >= size[0] * min_ratio and image.height >= size[1] * min_ratio
+                      and abs(image.width * size[1] - image.height * size[0]) <= max(image.width, image.height)]
+        if not candidates:
+            return self._converted
+        return min(candidates, key=lambda image: image.width * image.height)
+
+    def add_intermediate(self, image):
+        self._intermediates.append(image)
+
+    def close(self):
+        self._converted = None
+        self._converted_key = None
+        self._intermediates = []
+        self._reduce = 1
+        self._loaded = False
+        self.data = None
+        if self._image is not None:
+            self._image.close()
+            self._image = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
 
 
 class CurrentImage(object):
 
-    def __init__(self, source_filename, config_entry):
+    def __init__(self, source_filename, config_entry, source_image=None, backend=None):
         self.source_filename = source_filename
         self.config_entry = config_entry
+        self.source_image = source_image if source_image is not None else SourceImage(source_filename)
+        # backend of the rendered images, the one of the source image by default
+        self.backend = backend if backend is not None else PILLOW
+        # output of the same source with the same render key, which is reused
+        self.same_as = None
+        # converts the colors after resizing, see SourceImage.order_stages
+        self.resize_first = False
 
     @property
     def corename(self):
         return basename(self.source_filename).split('.')[0]
 
+    @property
+    def source_folder(self):
+        """folder of the source file relative to the source folder of the project"""
+        folder = relpath(dirname(abspath(self.source_filename)), abspath(self.config_entry.source))
+        return '' if folder == '.' or folder.startswith('..') else folder
+
     @property
     def subfolder(self):
-        return self.corename if self.config_entry.with_subfolder else ''
+        return join(self.source_folder, self.corename if self.config_entry.with_subfolder else '')
 
     @property
     def destination_basename(self):
-        return f"{self.config_entry.prefix}{self.corename}{self.config_entry.suffix}{self.config_entry.websetaddon}.{self.config_entry.ext}"
+        return f"{self.config_entry.name_prefix}{self.corename}{self.config_entry.name_suffix}"
 
     @property
     def destination_folder(self):
@@ -297,65 +1514,862 @@ class CurrentImage(object):
     def destination_filename(self):
         return join(self.destination_folder, self.destination_basename)
 
-    def generate(self):
-        self.print = Out.out  # TODO: refactor
-        if exists(self.destination_filename) and not self.config_entry.override:
-            self.print(f"ignore file: {self.destination_filename}")
-            return
+    def generate(self, skip_existing=True):
+        if skip_existing and exists(self.destination_filename) and not self.config_entry.override:
+            return f"ignore file: {self.destination_filename}"
         else:
-            self.print(f"creating: {self.destination_filename_short}")
-            logging.info(f"creating: {self.destination_filename_short}")
-
-        with Image.open(self.source_filename) as image:
-            if self.config_entry.mode != image.mode:
-                logging.debug(f"Source and destination mode differ. Source: {image.mode}, Destination: {self.config_entry.mode}")
-                image = self.convert(image)
-
-            profile = self.get_image_profile(image)
-            if profile is not None:
-                pass
-                # TODO needs implementation: should checked and converted together with mode. lines above.
+            logging.info("creating: %s", self.destination_filename_short)
+        return self.save(None if self.same_as is not None else self.render())
 
-            destination_size = Size(image.size).destination_size(self.config_entry.destination_size).size
-            resample = self.config_entry.resample
-            logging.debug(f"Resizing Image. Source: {Size(image.size)}, Destination: {destination_size}, Resample: {self.config_entry.resample_name}")
-            image = image.resize(destination_size, resample=resample)
+    @property
+    def render_key(self):
+        """settings which determine the pixels and the encoding of the output.
+        Outputs of one source with the same render key are identical."""
+        config_entry = self.config_entry
+        destination_size = Size(self.source_image.size).destination_size(config_entry.destination_size).size
+        return (destination_size, config_entry.resample, config_entry.mode, config_entry.color_profile,
+                config_entry.image_format, config_entry.encoder_options, config_entry.max_bytes,
+                config_entry.cascade and config_entry.cascade_ratio)
+
+    def render(self):
+        """returns the converted and resized image"""
+        if self.resize_first:
+            return self._resize_and_convert()
+        image = self.source_image.converted(self.conversion_key, self._convert_if_needed)
+        # TODO: images with an embedded profile in the destination mode are not transformed yet.
+
+        destination_size = Size(self.source_image.size).destination_size(self.config_entry.destination_size).size
+        resample = self.config_entry.resample
+        if self.config_entry.cascade:
+            image = self.source_image.resize_base(destination_size, self.config_entry.cascade_ratio)
+        if logging.root.isEnabledFor(logging.DEBUG):
+            logging.debug("Resizing Image. Source: %s, Destination: %s, Resample: %s",
+                          Size(image.size), destination_size, self.config_entry.resample_name)
+        timer = self.source_image.timer
+        with timer.stage('resize', self.config_entry):
+            image = self.backend.resize(image, destination_size, resample)
+        if self.config_entry.cascade:
+            self.source_image.add_intermediate(image)
+        return image
+
+    def _resize_and_convert(self):
+        image = self.source_image.image
+        destination_size = Size(self.source_image.size).destination_size(self.config_entry.destination_size).size
+        timer = self.source_image.timer
+        with timer.stage('resize', self.config_entry):
+            image = self.backend.resize(image, destination_size, self.config_entry.resample)
+        with timer.stage('convert', self.config_entry):
+            return self._convert_if_needed(image)
+
+    def save(self, image):
+        """writes the image to the destination file and returns the message.
+        Outputs with `same_as` are created from the saved file of that output."""
+        if self.same_as is not None:
+            mode = materialize(self.same_as.destination_filename, self.destination_filename,
+                               self.config_entry.dedupe or 'copy')
+            return f"{mode}: {self.destination_filename_short}"
+        timer = self.source_image.timer
+        with timer.stage('mkdir', self.config_entry):
+            created_folders.makedirs(self.destination_folder)
+
+        logging.debug("Writing %s", self.destination_filename)
+        with timer.stage('save', self.config_entry), atomic_destination(self.destination_filename) as temp_filename:
+            if self.config_entry.max_bytes:
+                with open(temp_filename, 'wb') as destination_file:
+                    destination_file.write(self.encode(image))
+            else:
+                self.backend.save(image, temp_filename, self.config_entry.image_format,
+                                  dict(self.config_entry.encoder_options))
+        return f"creating: {self.destination_filename_short}"
+
+    def encode(self, image):
+        """returns the image encoded with the encoder settings of the config entry"""
+        options = dict(self.config_entry.encoder_options)
+        if self.config_entry.max_bytes:
+            return encode_to_size(image, self.config_entry.image_format, options, self.config_entry.max_bytes,
+                                  self.backend.encode)
+        return self.backend.encode(image, self.config_entry.image_format, options)
 
-            if not exists(self.destination_folder):
-                makedirs(self.destination_folder)
+    @property
+    def conversion_key(self):
+        return (self.config_entry.mode, self.config_entry.color_profile)
 
-            logging.debug(f"Writing {self.destination_filename}")
-            image.save(self.destination_filename)
+    def _convert_if_needed(self, image):
+        if self.config_entry.mode != image.mode:
+            logging.debug("Source and destination mode differ. Source: %s, Destination: %s", image.mode, self.config_entry.mode)
+            return self.convert(image)
+        return image
 
     def convert(self, image):
-        source_profile = self.get_image_profile(image)
-        if source_profile is not None:
-            destination_profile = self.profile()
-            inMode = image.mode
-            outMode = self.config_entry.mode
-            logging.debug(f"Transforming {self.profile_name(source_profile)} -> {self.profile_name(destination_profile)}, {inMode} -> {outMode}")
-            transform = ImageCms.buildTransform(inputProfile=source_profile,
-                                                outputProfile=destination_profile,
-                                                inMode=inMode,
-                                                outMode=outMode,
-                                                renderingIntent=ImageCms.INTENT_RELATIVE_COLORIMETRIC)
-            return ImageCms.applyTransform(image, transform)
-        else:
-            logging.debug(f"Converting color modes. Source: {image.mode}, Destination: {self.config_entry.mode}")
-            return image.convert(mode=self.config_entry.mode)
+        return self.backend.convert(image, self.config_entry.mode, self.config_entry.color_profile)
 
     def get_image_profile(self, image):
-        try:
-            return ImageCms.ImageCmsProfile(io.BytesIO(image.info.get('icc_profile')))
-        except:
-            return None
+        return color_transforms.source_profile(image.info.get('icc_profile'))
 
     def profile_name(self, profile):
         return ImageCms.getProfileName(profile).strip()
 
     def profile(self):
-        if self.config_entry.color_profile is None:
-            return ImageCms.createProfile("sRGB")
+        return color_transforms.destination_profile(self.config_entry.color_profile)
+
+
+class ColorTransforms(object):
+    """LRU cache of ICC profiles and color transforms.
+
+    Source profiles are keyed by a hash of the embedded ICC bytes, destination
+    profiles by their name or file name. Transforms are keyed by
+    (source hash, destination profile, inMode, outMode, intent), so images
+    sharing an embedded profile reuse one transform. The transforms are built
+    without the lcms pixel cache, which makes them safe to share between
+    threads.
+    """
+
+    def __init__(self, maxsize=TRANSFORM_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            self._profiles = OrderedDict()
+            self._transforms = OrderedDict()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'transforms': len(self._transforms)}
+
+    def add_counts(self, hits, misses):
+        """adds the counters of the cache of a worker process"""
+        with self._lock:
+            self.hits += hits
+            self.misses += misses
+
+    def _cached(self, cache, key, create):
+        with self._lock:
+            if key in cache:
+                cache.move_to_end(key)
+                return cache[key]
+        value = create()
+        with self._lock:
+            cache[key] = value
+            if len(cache) > self.maxsize:
+                cache.popitem(last=False)
+        return value
+
+    @staticmethod
+    def _hash(icc_profile):
+        return hashlib.sha1(icc_profile).hexdigest()
+
+    def source_profile(self, icc_profile):
+        """returns the parsed embedded profile or None if there is no valid one"""
+        if not icc_profile:
+            return None
+
+        def parse():
+            try:
+                return ImageCms.ImageCmsProfile(io.BytesIO(icc_profile))
+            except (OSError, ImageCms.PyCMSError):
+                return None
+
+        return self._cached(self._profiles, ('source', self._hash(icc_profile)), parse)
+
+    def destination_profile(self, color_profile=None):
+        """returns one of the built in profiles 'sRGB', 'LAB' or 'XYZ' or the
+        profile of an ICC file. Defaults to 'sRGB'."""
+        color_profile = color_profile or 'sRGB'
+
+        def load():
+            if color_profile in BUILTIN_PROFILES:
+                return ImageCms.ImageCmsProfile(ImageCms.createProfile(color_profile))
+            return ImageCms.ImageCmsProfile(color_profile)
+
+        return self._cached(self._profiles, ('destination', color_profile), load)
+
+    def transform(self, icc_profile, color_profile, inMode, outMode,
+                  intent=ImageCms.INTENT_RELATIVE_COLORIMETRIC):
+        """returns the transform from the embedded profile to `color_profile` or
+        None if the image has no valid embedded profile"""
+        source_profile = self.source_profile(icc_profile)
+        if source_profile is None:
+            return None
+        key = (self._hash(icc_profile), color_profile or 'sRGB', inMode, outMode, intent)
+        with self._lock:
+            if key in self._transforms:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+        def build():
+            destination_profile = self.destination_profile(color_profile)
+            if logging.root.isEnabledFor(logging.DEBUG):
+                logging.debug("Building transform %s -> %s, %s -> %s", ImageCms.getProfileName(source_profile).strip(),
+                              ImageCms.getProfileName(destination_profile).strip(), inMode, outMode)
+            return ImageCms.buildTransform(inputProfile=source_profile,
+                                           outputProfile=destination_profile,
+                                           inMode=inMode,
+                                           outMode=outMode,
+                                           renderingIntent=intent,
+                                           flags=ImageCms.FLAGS["NOTCACHE"])
+
+        return self._cached(self._transforms, key, build)
+
+
+color_transforms = ColorTransforms()
+
+
+class StageTimer(object):
+    """Measures the duration of the processing stages of one source file.
+
+    The events are (source file, config label, stage, seconds) tuples. The
+    config label is None for the stages shared by all outputs of a source.
+    """
+
+    def __init__(self, source_filename):
+        self.source_filename = source_filename
+        self.events = []
+
+    @contextmanager
+    def stage(self, name, config_entry=None):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            label = config_entry.label if config_entry is not None else None
+            self.events.append((self.source_filename, label, name, perf_counter() - start))
+
+
+class NullTimer(object):
+    """Timer used while the instrumentation is disabled. It records nothing."""
+
+    events = ()
+    _context = nullcontext()
+
+    def stage(self, name, config_entry=None):
+        return self._context
+
+
+NULL_TIMER = NullTimer()
+
+
+class StageHook(object):
+    """Interface of the instrumentation hooks.
+
+    `stage` is called in the main process for every stage event of a source
+    file once the source file is done, `event` for the other events of the
+    run (see `EventLog`) and `finish` at the end of the run.
+    """
+
+    def stage(self, source_filename, label, stage, seconds):
+        pass
+
+    def event(self, name, fields):
+        pass
+
+    def finish(self):
+        pass
+
+
+class Instrumentation(object):
+    """Dispatches the stage events to the registered hooks. It is enabled as
+    soon as a hook is registered."""
+
+    def __init__(self):
+        self.hooks = []
+
+    @property
+    def enabled(self):
+        return bool(self.hooks)
+
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+
+    def remove_hook(self, hook):
+        self.hooks.remove(hook)
+
+    def reset(self):
+        self.hooks = []
+
+    def record(self, events):
+        for event in events:
+            for hook in self.hooks:
+                hook.stage(*event)
+
+    def emit(self, name, **fields):
+        for hook in self.hooks:
+            hook.event(name, fields)
+
+    def finish(self):
+        for hook in self.hooks:
+            hook.finish()
+
+
+instrumentation = Instrumentation()
+
+
+class StageReport(StageHook):
+    """Collects the stage events and writes a summary report at the end of the run.
+
+    The report contains totals and percentiles per stage, the slowest source
+    files and the cost per config. It is written as JSON to `filename` and
+    printed as a table.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.stages = {}
+        self.sources = {}
+        self.configs = {}
+        self.start = perf_counter()
+
+    def stage(self, source_filename, label, stage, seconds):
+        self.stages.setdefault(stage, []).append(seconds)
+        self.sources[source_filename] = self.sources.get(source_filename, 0) + seconds
+        if label is not None:
+            self.configs[label] = self.configs.get(label, 0) + seconds
+
+    @staticmethod
+    def percentile(values, percent):
+        return values[min(int(len(values) * percent / 100), len(values) - 1)]
+
+    def summary(self):
+        stages = {}
+        for stage in sorted(self.stages, key=lambda stage: STAGES.index(stage) if stage in STAGES else len(STAGES)):
+            values = sorted(self.stages[stage])
+            stages[stage] = {'count': len(values),
+                             'total': sum(values),
+                             'mean': sum(values) / len(values),
+                             'p50': self.percentile(values, 50),
+                             'p90': self.percentile(values, 90),
+                             'p99': self.percentile(values, 99),
+                             'max': values[-1]}
+        slowest = sorted(self.sources.items(), key=lambda item: item[1], reverse=True)[:REPORT_SLOWEST]
+        return {'wall_time': perf_counter() - self.start,
+                'sources': len(self.sources),
+                'stages': stages,
+                'slowest': [{'source': source, 'seconds': seconds} for source, seconds in slowest],
+                'configs': dict(sorted(self.configs.items(), key=lambda item: item[1], reverse=True))}
+
+    def table(self, summary):
+        lines = [f"{'stage':<10}{'count':>8}{'total s':>10}{'mean ms':>10}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}"]
+        for stage, values in summary['stages'].items():
+            lines.append(f"{stage:<10}{values['count']:>8}{values['total']:>10.2f}{values['mean'] * 1000:>10.1f}"
+                         f"{values['p50'] * 1000:>10.1f}{values['p90'] * 1000:>10.1f}{values['p99'] * 1000:>10.1f}")
+        lines.append('slowest files:')
+        lines.extend(f"  {slow['seconds']:>8.2f} s  {slow['source']}" for slow in summary['slowest'])
+        lines.append('cost per config:')
+        lines.extend(f"  {seconds:>8.2f} s  {label}" for label, seconds in summary['configs'].items())
+        return '\n'.join(lines)
+
+    def finish(self):
+        summary = self.summary()
+        with open(self.filename, 'w') as report_file:
+            json.dump(summary, report_file, indent=2)
+        Out.out(self.table(summary))
+
+
+class EventLog(StageHook):
+    """Appends the events of the runs as JSON lines to `filename`, to be
+    followed by external monitoring.
+
+    Every line has the `time` (seconds since the epoch) and the `event`:
+    run_started, run_finished, started and finished per source file, skipped
+    for a source file with current outputs only, error and stage with the
+    duration of a processing stage. The lines are written unbuffered, so a
+    reader sees every event when it happens.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._file = open(filename, 'a', buffering=1)
+
+    def _write(self, event):
+        self._file.write(json.dumps(event) + '\n')
+
+    def stage(self, source_filename, label, stage, seconds):
+        self._write({'time': time(), 'event': 'stage', 'source': source_filename,
+                     'config': label, 'stage': stage, 'seconds': seconds})
+
+    def event(self, name, fields):
+        event = {'time': time(), 'event': name}
+        event.update(fields)
+        self._write(event)
+
+    def finish(self):
+        self._file.close()
+
+
+class Deduplicator(object):
+    """Finds byte-identical sources and creates their outputs from the outputs
+    of the first copy instead of rendering them again.
+
+    The sources with outdated outputs are hashed while they are passed through
+    `originals`, which holds back every source with the content of an earlier
+    one. Sources with current outputs are not read. After the originals are
+    processed, `reuse` creates the outputs of a duplicate by `materialize`
+    with the dedupe mode.
+    """
+
+    def __init__(self, manifest, mode='copy'):
+        self.manifest = manifest
+        self.mode = mode
+        self.duplicates = []
+        self._originals = {}
+        self._original_of = {}
+        self.outputs = 0
+        self.saved_bytes = 0
+        self.modes = {}
+
+    def originals(self, work):
+        """passes through the (file name, config entries) pairs of the first copy of every content"""
+        for filename, config_entries in work:
+            try:
+                content_hash = self.manifest.source_hash(filename)
+            except OSError as error:
+                logging.warning(f"Cannot hash {filename}: {error}")
+                yield filename, config_entries
+                continue
+            original = self._originals.setdefault(content_hash, filename)
+            if original == filename:
+                yield filename, config_entries
+            else:
+                logging.debug("%s is a duplicate of %s", filename, original)
+                self._original_of[filename] = original
+                self.duplicates.append((filename, config_entries))
+
+    def reuse(self, filename, config_entries, report=None):
+        """creates the outputs of the duplicate `filename` from the outputs of its
+        original and returns the config entries of the created outputs"""
+        original = self._original_of[filename]
+        created = []
+        for config_entry in config_entries:
+            destination = CurrentImage(filename, config_entry).destination_filename
+            try:
+                mode = materialize(CurrentImage(original, config_entry).destination_filename, destination, self.mode)
+            except OSError as error:
+                logging.warning(f"Cannot reuse output of {original} for {destination}: {error}")
+                continue
+            self.modes[mode] = self.modes.get(mode, 0) + 1
+            self.outputs += 1
+            created.append(config_entry)
+            if report is not None:
+                report(f"{mode}: {destination}")
+        if created:
+            self.saved_bytes += self.manifest.source_state(filename)['size']
+        return created
+
+    def report(self):
+        if not self.outputs:
+            return
+        modes = ', '.join(f"{count} {mode}" for mode, count in self.modes.items()) or 'none'
+        message = (f"Deduplication: {len(self.duplicates)} duplicate source(s), {self.outputs} output(s) "
+                   f"not rendered ({modes}), {self.saved_bytes / 1024 / 1024:.1f} MB of sources not decoded")
+        logging.info(message)
+        Out.out(message)
+
+
+def _reflink(source_file, destination_file):
+    """clones the content of `source_file` into `destination_file` on file systems
+    supporting it and returns True on success"""
+    if fcntl is None:
+        return False
+    try:
+        fcntl.ioctl(destination_file.fileno(), FICLONE, source_file.fileno())
+    except OSError:
+        return False
+    return True
+
+
+def materialize(source, destination, mode='copy'):
+    """creates `destination` with the content of the existing file `source` as
+    a hardlink, a reflink or a copy and returns the mode used.
+
+    Hardlinks and reflinks fall back to a copy if the file system does not
+    support them. The destination is replaced atomically.
+    """
+    created_folders.makedirs(dirname(destination))
+    if mode == 'hardlink' and exists(destination) and samefile(source, destination):
+        return mode
+    with atomic_destination(destination) as temp_filename:
+        if mode == 'hardlink':
+            remove(temp_filename)
+            try:
+                link(source, temp_filename)
+                return mode
+            except OSError:
+                mode = 'copy'
+        with open(source, 'rb') as source_file, open(temp_filename, 'wb') as destination_file:
+            if mode != 'reflink' or not _reflink(source_file, destination_file):
+                mode = 'copy'
+                shutil.copyfileobj(source_file, destination_file)
+    return mode
+
+
+def file_mode(filename):
+    """returns the permission bits of `filename`, or those of a new file if it does not exist"""
+    try:
+        return stat(filename).st_mode & 0o7777
+    except FileNotFoundError:
+        return 0o666 & ~UMASK
+
+
+@contextmanager
+def atomic_destination(destination):
+    """yields the name of a temporary file next to `destination`, which replaces
+    `destination` when the block succeeds and is removed otherwise. So an
+    interrupted run never leaves a partially written output."""
+    folder, name = dirname(destination) or '.', basename(destination)
+    descriptor, temp_filename = tempfile.mkstemp(dir=folder, prefix=f".{name}.", suffix=f".tmp{splitext(name)[1]}")
+    close(descriptor)
+    try:
+        yield temp_filename
+        # mkstemp creates the file readable by its owner only, a hardlink keeps the mode of its original
+        if stat(temp_filename).st_nlink == 1:
+            chmod(temp_filename, file_mode(destination))
+        replace(temp_filename, destination)
+    finally:
+        if exists(temp_filename):
+            remove(temp_filename)
+
+
+def remove_temp_files(folder, names):
+    """removes the temporary files `names` of `atomic_destination` left in `folder` by an interrupted run"""
+    for name in names:
+        try:
+            remove(join(folder, name))
+            logging.debug("Removed temporary file %s", join(folder, name))
+        except OSError as error:
+            logging.warning(f"Cannot remove temporary file {join(folder, name)}: {error}")
+
+
+class CreatedFolders(object):
+    """Folders created during the run, so every folder is created only once."""
+
+    def __init__(self):
+        self._folders = set()
+
+    def clear(self):
+        self._folders = set()
+
+    def makedirs(self, folder):
+        if folder and folder not in self._folders:
+            makedirs(folder, exist_ok=True)
+            self._folders.add(folder)
+
+
+created_folders = CreatedFolders()
+
+
+class Journal(object):
+    """Append-only record of the outputs done by a run.
+
+    An output is recorded by its destination path relative to the destination
+    folder, like in the manifest, together with the hash of its config.
+
+    Items are appended in batches of `flush_size` to a JSON lines file in the
+    destination folder. The journal is removed when the run completes. After
+    an interrupted run, a run with `resume` skips the items in the journal
+    without checking their outputs and continues the journal. A sharded run
+    keeps a journal file of its own, so shards sharing the destination folder
+    do not touch the journals of each other.
+    """
+
+    def __init__(self, folder, resume=False, flush_size=JOURNAL_FLUSH_SIZE, shard=None):
+        self.folder = folder
+        if shard is None:
+            self.filename = join(folder, JOURNAL_FILENAME)
+        else:
+            self.filename = join(folder, SHARD_JOURNAL_FILENAME.format(index=shard[0], count=shard[1]))
+        self.flush_size = flush_size
+        self.done = set()
+        self._pending = []
+        if resume:
+            self._load()
+        elif exists(self.filename):
+            remove(self.filename)
+
+    def _load(self):
+        if not exists(self.filename):
+            return
+        with open(self.filename) as journal_file:
+            for line in journal_file:
+                try:
+                    output, config_hash = json.loads(line)
+                except (ValueError, TypeError):
+                    logging.warning(f"Ignoring invalid journal line in {self.filename}: {line!r}")
+                    continue
+                self.done.add((output, config_hash))
+        logging.info(f"Resuming after {len(self.done)} output(s) done according to {self.filename}")
+
+    def _key(self, source_filename, config_entry):
+        output = relpath(CurrentImage(source_filename, config_entry).destination_filename, self.folder)
+        return output, config_entry.config_hash
+
+    def is_done(self, source_filename, config_entry):
+        return bool(self.done) and self._key(source_filename, config_entry) in self.done
+
+    def record(self, source_filename, config_entries):
+        for config_entry in config_entries:
+            self._pending.append(self._key(source_filename, config_entry))
+        if len(self._pending) >= self.flush_size:
+            self.flush()
+
+    def flush(self):
+        if not self._pending:
+            return
+        created_folders.makedirs(self.folder)
+        with open(self.filename, 'a') as journal_file:
+            journal_file.writelines(json.dumps(item) + '\n' for item in self._pending)
+            journal_file.flush()
+        self.done.update(self._pending)
+        self._pending = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *args):
+        if exc_type is None:
+            self._pending = []
+            if exists(self.filename):
+                remove(self.filename)
+        else:
+            self.flush()
+
+
+class MetadataIndex(object):
+    """Persistent index of the header metadata of source files.
+
+    The metadata from `read_header` is stored with the path, size and
+    modification time of the source in a JSON lines file, so repeated plans
+    and runs do not open the sources again. New entries are appended when
+    the index is closed.
+    """
+
+    def __init__(self, folder, flush_size=MANIFEST_FLUSH_SIZE):
+        self.folder = folder
+        self.filename = join(folder, METADATA_FILENAME)
+        self.flush_size = flush_size
+        self.entries = {entry['source']: entry for entry in read_manifest(self.filename, key='source')}
+        self._lines = len(self.entries)
+        self._pending = []
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, filename):
+        """returns the header metadata of `filename` or None if it cannot be read"""
+        try:
+            source_stat = stat(filename)
+        except OSError:
+            return None
+        source = abspath(filename)
+        entry = self.entries.get(source)
+        if entry is not None and entry['size'] == source_stat.st_size and entry['mtime'] == source_stat.st_mtime_ns:
+            self.hits += 1
+            return entry
+        self.misses += 1
+        header = read_header(filename)
+        if header is None:
+            return None
+        entry = dict(header, source=source, size=source_stat.st_size, mtime=source_stat.st_mtime_ns)
+        self.entries[source] = entry
+        self._pending.append(entry)
+        if len(self._pending) >= self.flush_size:
+            self.flush()
+        return entry
+
+    def flush(self):
+        if not self._pending:
+            return
+        created_folders.makedirs(self.folder)
+        with open(self.filename, 'a') as index_file:
+            index_file.writelines(json.dumps(entry) + '\n' for entry in self._pending)
+        self._lines += len(self._pending)
+        self._pending = []
+
+    def close(self):
+        self.flush()
+        if self._lines > 2 * len(self.entries):
+            with atomic_destination(self.filename) as temp_filename, open(temp_filename, 'w') as index_file:
+                index_file.writelines(json.dumps(entry) + '\n' for entry in self.entries.values())
+            self._lines = len(self.entries)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class Manifest(object):
+    """Record of the generated outputs of a destination folder.
+
+    A sharded run reads the manifest, but appends its records to a manifest
+    file of its own, which is merged by `Project.merge_shards`.
+
+    Every output is stored with the size and modification time of its source
+    and the hash of its config entry in a JSON lines file. An output is
+    current, if it exists and neither its source nor its config changed since
+    it was generated. Outputs generated before the manifest existed are
+    adopted as they are. The content hash of the source is stored, if it was
+    computed anyway (e.g. for deduplication) or with `hash_sources`, which
+    costs a second read of every processed source. A source with a new
+    modification time is then compared by its hash instead of being outdated. The existence of the outputs is checked
+    by listing each destination folder once.
+
+    Records are appended in batches, later lines override earlier ones. When
+    disabled only the existence of the outputs is checked.
+
+    Temporary files left in a listed folder by an interrupted run are removed,
+    unless the run is sharded and another shard may still be writing them.
+    """
+
+    def __init__(self, folder, enabled=True, flush_size=MANIFEST_FLUSH_SIZE, shard=None, hash_sources=False):
+        self.folder = folder
+        self.filename = join(folder, MANIFEST_FILENAME)
+        self.shard = shard
+        self.enabled = enabled
+        self.hash_sources = hash_sources
+        self.flush_size = flush_size
+        self.entries = {}
+        self._lines = 0
+        self._pending = []
+        self._listings = {}
+        self._sources = {}
+        if enabled:
+            self._load(self.filename)
+        if shard is not None:
+            self.filename = join(folder, SHARD_MANIFEST_FILENAME.format(index=shard[0], count=shard[1]))
+            self._lines = 0
+            if enabled:
+                self._load(self.filename)
+
+    def _load(self, filename):
+        for entry in read_manifest(filename):
+            self.entries[entry['output']] = entry
+            self._lines += 1
+        logging.debug(f"Loaded {len(self.entries)} manifest entries from {filename}")
+
+    def refresh(self):
+        """forgets the cached source states and folder listings, e.g. between two batches"""
+        self._listings = {}
+        self._sources = {}
+
+    def exists(self, filename):
+        folder = dirname(filename)
+        if folder not in self._listings:
+            try:
+                with scandir(folder or '.') as entries:
+                    names = {entry.name for entry in entries}
+            except OSError:
+                names = set()
+            temp_names = {name for name in names if TEMP_FILENAME.match(name)}
+            if temp_names and self.shard is None:
+                remove_temp_files(folder, temp_names)
+            self._listings[folder] = names - temp_names
+        return basename(filename) in self._listings[folder]
+
+    def source_state(self, source_filename):
+        """returns size, modification time and content hash of the source.
+        The hash is computed once per run and only on demand."""
+        if source_filename not in self._sources:
+            source_stat = stat(source_filename)
+            self._sources[source_filename] = {'size': source_stat.st_size,
+                                              'mtime': source_stat.st_mtime_ns,
+                                              'hash': None}
+        return self._sources[source_filename]
+
+    def source_hash(self, source_filename):
+        state = self.source_state(source_filename)
+        if state['hash'] is None:
+            state['hash'] = file_hash(source_filename)
+        return state['hash']
+
+    def key(self, current_image):
+        """returns the name of the output of `current_image` in the manifest"""
+        return relpath(current_image.destination_filename, self.folder)
+
+    def is_current(self, current_image, adopt=True):
+        """returns True if the output of `current_image` is up to date. Existing
+        outputs without an entry and sources with a new modification time but
+        the same content as the recorded hash are recorded. Without `adopt` nothing is recorded or
+        hashed, and an output of a modified source counts as outdated."""
+        if not self.exists(current_image.destination_filename):
+            return False
+        if not self.enabled:
+            return True
+        key = self.key(current_image)
+        entry = self.entries.get(key)
+        if entry is None:
+            if adopt:
+                logging.debug("Adopting existing output %s", key)
+                self.record(current_image.source_filename, [current_image.config_entry])
+            return True
+        if entry.get('config') != current_image.config_entry.config_hash:
+            return False
+        state = self.source_state(current_image.source_filename)
+        if entry.get('size') == state['size'] and entry.get('mtime') == state['mtime']:
+            return True
+        if not adopt or entry.get('size') != state['size'] or entry.get('hash') is None:
+            return False
+        if entry.get('hash') != self.source_hash(current_image.source_filename):
+            return False
+        self.record(current_image.source_filename, [current_image.config_entry])
+        return True
+
+    def record(self, source_filename, config_entries):
+        """records the outputs of `source_filename` generated with `config_entries`"""
+        if not self.enabled:
+            return
+        state = self.source_state(source_filename)
+        for config_entry in config_entries:
+            current_image = CurrentImage(source_filename, config_entry)
+            entry = {'output': self.key(current_image),
+                     'source': source_filename,
+                     'size': state['size'],
+                     'mtime': state['mtime'],
+                     'hash': self.source_hash(source_filename) if self.hash_sources else state['hash'],
+                     'config': config_entry.config_hash}
+            self.entries[entry['output']] = entry
+            self._pending.append(entry)
+            self._listings.setdefault(dirname(current_image.destination_filename), set()).add(current_image.destination_basename)
+        if len(self._pending) >= self.flush_size:
+            self.flush()
+
+    def merge(self, entries):
+        """records manifest `entries`, e.g. of a shard manifest, later entries override earlier ones"""
+        for entry in entries:
+            self.entries[entry['output']] = entry
+            self._pending.append(entry)
+        if len(self._pending) >= self.flush_size:
+            self.flush()
+
+    def flush(self):
+        if not self._pending:
+            return
+        created_folders.makedirs(self.folder)
+        with open(self.filename, 'a') as manifest_file:
+            manifest_file.writelines(json.dumps(entry) + '\n' for entry in self._pending)
+        self._lines += len(self._pending)
+        self._pending = []
+
+    def compact(self):
+        """rewrites the manifest with one line per output"""
+        temp_filename = self.filename + '.tmp'
+        with open(temp_filename, 'w') as manifest_file:
+            manifest_file.writelines(json.dumps(entry) + '\n' for entry in self.entries.values())
+        replace(temp_filename, self.filename)
+        self._lines = len(self.entries)
+
+    def close(self):
+        self.flush()
+        if self.enabled and self.shard is None and self._lines > 2 * len(self.entries):
+            self.compact()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
 
 
 class PyImgBatch:
@@ -367,6 +2381,88 @@ class PyImgBatch:
     def exec(self):
         self.options.exec()
 
+    def print_plan(self):
+        self.options.print_plan()
+
+    def merge(self):
+        return self.options.merge()
+
+    def estimate(self):
+        return self.options.estimate()
+
+
+def _project_plan(project, args):
+    if isinstance(project, list):
+        project = {OPTIONKEY.CONFIGS: project}
+    project = dict(project)
+    project.setdefault(OPTIONKEY.SOURCE, '.')
+    project[OPTIONKEY.PILLOWONLY] = 'process_images'
+    options = Options({OPTIONKEY.PROJECTS: [project]}, defaults=Args(args))
+    return Project(project, defaults=options).plan
+
+
+def process_image(name, source, plan):
+    """yields (output name, bytes, metadata) for every output of one source image.
+    `source` is the content of the image file as bytes or a file-like object."""
+    encoded = {}
+    with SourceImage(name, data=source) as source_image:
+        for current_image in source_image.prepare(plan.outputs):
+            if current_image.same_as is not None:
+                image, data = encoded[current_image.same_as]
+            else:
+                image = current_image.render()
+                data = current_image.encode(image)
+                encoded[current_image] = image, data
+            metadata = {'source': name,
+                        'config': current_image.config_entry.label,
+                        'size': image.size,
+                        'mode': image.mode,
+                        'format': current_image.config_entry.image_format,
+                        'bytes': len(data)}
+            yield current_image.destination_filename_short, data, metadata
+
+
+def process_images(images, project, **args):
+    """processes images in memory, without touching the disk.
+
+    `images` is an iterable of (name, bytes or file-like object) pairs and
+    `project` a project dict or a list of config dicts, like in a project
+    file. The outputs are yielded lazily as (output name, bytes, metadata),
+    where the output name is the destination file name relative to the
+    destination folder. Further settings can be passed as keyword arguments.
+
+        for name, data, metadata in process_images([('a.jpg', data)], [{'width': 300}]):
+            ...
+    """
+    plan = _project_plan(project, args)
+    for name, source in images:
+        yield from process_image(name, source, plan)
+
+
+async def aprocess_images(images, project, executor=None, **args):
+    """asyncio variant of `process_images`.
+
+    `images` may be an iterable or an async iterable. Every image is processed
+    in `executor` (the default executor of the loop if None), so the event loop
+    is not blocked. The outputs of an image are yielded when it is done.
+    """
+    plan = _project_plan(project, args)
+    loop = asyncio.get_running_loop()
+
+    async def process(name, source):
+        results = await loop.run_in_executor(executor, lambda: list(process_image(name, source, plan)))
+        for result in results:
+            yield result
+
+    if hasattr(images, '__aiter__'):
+        async for name, source in images:
+            async for result in process(name, source):
+                yield result
+    else:
+        for name, source in images:
+            async for result in process(name, source):
+                yield result
+
 
 class Size(object):
 
@@ -448,6 +2544,403 @@ class Out:
         cls.project_bar.close()
 
 
+def encode(image, image_format, options):
+    with io.BytesIO() as buffer:
+        image.save(buffer, image_format, **options)
+        return buffer.getvalue()
+
+
+def encode_to_size(image, image_format, options, max_bytes, encoder=encode):
+    """encodes the image with the highest quality, which fits into `max_bytes`.
+
+    The quality is searched by bisection over in-memory encodes by `encoder`
+    between MIN_QUALITY and the configured quality (or MAX_QUALITY). Formats
+    without a quality setting are encoded once. If even the lowest quality is
+    too large, the lowest quality is used.
+    """
+    if CONFKEY.QUALITY not in ENCODER_KEYS.get(image_format, []) or options.get(CONFKEY.LOSSLESS):
+        data = encoder(image, image_format, options)
+        if len(data) > max_bytes:
+            logging.warning(f"{image_format} image of {len(data)} bytes exceeds max_bytes {max_bytes}")
+        return data
+    low, high = MIN_QUALITY, int(options.get(CONFKEY.QUALITY, MAX_QUALITY))
+    best = encoder(image, image_format, dict(options, quality=high))
+    if len(best) <= max_bytes:
+        return best
+    best, high = None, high - 1
+    for _ in range(QUALITY_SEARCH_STEPS):
+        if low > high:
+            break
+        quality = (low + high + 1) // 2
+        data = encoder(image, image_format, dict(options, quality=quality))
+        if len(data) <= max_bytes:
+            best = data
+            low = quality + 1
+        else:
+            high = quality - 1
+    if best is None:
+        best = encoder(image, image_format, dict(options, quality=MIN_QUALITY))
+        if len(best) > max_bytes:
+            logging.warning(f"Image of {len(best)} bytes at quality {MIN_QUALITY} exceeds max_bytes {max_bytes}")
+    return best
+
+
+class Backend(object):
+    """Interface of the image processing engines.
+
+    A backend opens source images, converts them into a color mode and
+    profile, resizes and encodes them. The images are objects of the engine.
+    `process_source` generates the outputs of a source file with these
+    operations and writes them like the Pillow pipeline does.
+    """
+
+    name = None
+    available = True
+
+    def open(self, source, outputs=1):
+        """opens a source file name or the bytes of a file for `outputs` outputs"""
+        raise NotImplementedError
+
+    def size(self, image):
+        raise NotImplementedError
+
+    def mode(self, image):
+        """the Pillow name of the color mode of the image"""
+        raise NotImplementedError
+
+    def convert(self, image, mode, color_profile):
+        """converts the image into `mode`. Images with an embedded profile are
+        transformed into `color_profile`, sRGB if None."""
+        raise NotImplementedError
+
+    def resize(self, image, size, resample):
+        raise NotImplementedError
+
+    def encode(self, image, image_format, options):
+        """returns the image encoded in `image_format` with the Pillow encoder settings `options`"""
+        raise NotImplementedError
+
+    def save(self, image, filename, image_format, options):
+        with open(filename, 'wb') as destination_file:
+            destination_file.write(self.encode(image, image_format, options))
+
+    def process_source(self, filename, config_entries, report, timer=NULL_TIMER):
+        """generates the outputs of `config_entries` from one source file and
+        passes the messages to `report`"""
+        source_image = SourceImage(filename, timer)
+        with timer.stage('open'):
+            image = self.open(filename, len(config_entries))
+        source_size = Size(self.size(image))
+        for config_entry in config_entries:
+            current_image = CurrentImage(filename, config_entry, source_image, backend=self)
+            logging.info("creating: %s", current_image.destination_filename_short)
+            converted = image
+            if self.mode(image) != config_entry.mode:
+                with timer.stage('convert', config_entry):
+                    converted = self.convert(image, config_entry.mode, config_entry.color_profile)
+            destination_size = source_size.destination_size(config_entry.destination_size).size
+            with timer.stage('resize', config_entry):
+                resized = self.resize(converted, destination_size, config_entry.resample)
+            report(current_image.save(resized))
+
+
+class PillowBackend(Backend):
+    """The default backend. It decodes a source once for all its outputs by a
+    `SourceImage`, which supports cascaded resizing and fast decoding."""
+
+    name = 'pillow'
+
+    def open(self, source, outputs=1):
+        return Image.open(io.BytesIO(source) if isinstance(source, (bytes, bytearray, memoryview)) else source)
+
+    def size(self, image):
+        return image.size
+
+    def mode(self, image):
+        return image.mode
+
+    def convert(self, image, mode, color_profile):
+        transform = color_transforms.transform(image.info.get('icc_profile'), color_profile, image.mode, mode)
+        if transform is not None:
+            return ImageCms.applyTransform(image, transform)
+        logging.debug("Converting color modes. Source: %s, Destination: %s", image.mode, mode)
+        return image.convert(mode=mode)
+
+    def resize(self, image, size, resample):
+        return image.resize(size, resample=resample)
+
+    def encode(self, image, image_format, options):
+        return encode(image, image_format, options)
+
+    def save(self, image, filename, image_format, options):
+        image.save(filename, image_format, **options)
+
+    def process_source(self, filename, config_entries, report, timer=NULL_TIMER):
+        with SourceImage(filename, timer) as source_image:
+            for current_image in source_image.prepare(config_entries):
+                report(current_image.generate(skip_existing=False))
+
+
+class VipsBackend(Backend):
+    """Backend on libvips by pyvips, available if pyvips is installed.
+
+    libvips processes images in small regions on demand, so a source with a
+    single output is streamed from decoding to encoding and large images need
+    a fraction of the memory. The outputs match the ones of Pillow in size,
+    mode and format, the pixels differ slightly by the resampling filters.
+    Color modes other than L, LA, RGB, RGBA and CMYK are not supported.
+    """
+
+    name = 'vips'
+    available = pyvips is not None
+
+    def open(self, source, outputs=1):
+        access = 'sequential' if outputs == 1 else 'random'
+        if isinstance(source, (bytes, bytearray, memoryview)):
+            return pyvips.Image.new_from_buffer(bytes(source), '', access=access)
+        return pyvips.Image.new_from_file(source, access=access)
+
+    def size(self, image):
+        return image.width, image.height
+
+    def mode(self, image):
+        interpretation = image.interpretation
+        if interpretation in ('b-w', 'grey16'):
+            mode = 'L'
+        elif interpretation == 'cmyk':
+            mode = 'CMYK'
+        else:
+            mode = 'RGB'
+        if image.format != 'uchar':
+            return f"{mode};16"
+        return f"{mode}A" if image.hasalpha() and mode != 'CMYK' else mode
+
+    @staticmethod
+    def _split(image):
+        """returns the color bands in 8 bit and the alpha band or None"""
+        if image.interpretation in ('grey16', 'rgb16'):
+            image = image.colourspace('b-w' if image.interpretation == 'grey16' else 'srgb')
+        elif image.format != 'uchar':
+            image = image.cast('uchar')
+        if image.hasalpha():
+            return image.extract_band(0, n=image.bands - 1), image.extract_band(image.bands - 1)
+        return image, None
+
+    def convert(self, image, mode, color_profile):
+        """converts like Pillow: by the embedded profile if there is one, else by
+        the formulas of `Image.convert`"""
+        if mode not in VIPS_INTERPRETATIONS:
+            raise ValueError(f"Color mode {mode} is not supported by the vips backend")
+        if image.get_typeof('icc-profile-data'):
+            profile = color_profile or ('cmyk' if mode == 'CMYK' else 'srgb')
+            image = image.icc_transform(profile.lower() if profile in BUILTIN_PROFILES else profile, embedded=True)
+        color, alpha = self._split(image)
+        source, target = self.mode(color), mode.rstrip('A') if mode != 'CMYK' else mode
+        if source == 'CMYK' and target != 'CMYK':
+            color, source = (255 - color[0:3]) * (255 - color[3]) / 255, 'RGB'
+        if source == 'L' and target == 'RGB':
+            color = color.bandjoin([color, color])
+        elif source == 'L' and target == 'CMYK':
+            black = color * 0
+            color = black.bandjoin([black, black, 255 - color])
+        elif source == 'RGB' and target == 'L':
+            color = color.recomb([[0.299, 0.587, 0.114]])
+        elif source == 'RGB' and target == 'CMYK':
+            color = (255 - color).bandjoin(0)
+        color = color.rint().cast('uchar').copy(interpretation=VIPS_INTERPRETATIONS[target])
+        if mode in ('LA', 'RGBA'):
+            color = color.bandjoin(alpha if alpha is not None else 255)
+        return color
+
+    def resize(self, image, size, resample):
+        width, height = size
+        if (image.width, image.height) == (width, height):
+            return image
+        alpha = image.hasalpha()
+        if alpha:
+            image = image.premultiply()
+        image = image.resize(width / image.width, vscale=height / image.height,
+                             kernel=VIPS_KERNELS[RESAMPLE_NAMES[resample]])
+        if alpha:
+            image = image.unpremultiply().cast('uchar')
+        if (image.width, image.height) != (width, height):
+            image = image.gravity('north-west', width, height, extend='copy')
+        return image
+
+    def encode(self, image, image_format, options):
+        names = VIPS_OPTIONS.get(image_format, {})
+        vips_options = {names[key]: value for key, value in options.items() if key in names}
+        if image_format == 'JPEG' and CONFKEY.SUBSAMPLING in options:
+            vips_options['subsample_mode'] = 'off' if options[CONFKEY.SUBSAMPLING] in (0, '4:4:4') else 'on'
+        return image.write_to_buffer(VIPS_SUFFIXES.get(image_format, '.jpg'), strip=True, **vips_options)
+
+
+PILLOW = PillowBackend()
+BACKENDS = {'pillow': PILLOW, 'vips': VipsBackend()}
+_backend_warnings = set()
+
+
+def _warn_backend(message):
+    if message not in _backend_warnings:
+        _backend_warnings.add(message)
+        logging.warning(message)
+
+
+def get_backend(name):
+    """returns the backend `name` or Pillow, if it is not available"""
+    backend = BACKENDS.get(name, PILLOW)
+    if not backend.available:
+        _warn_backend(f"Backend '{name}' is not available, using Pillow instead")
+        return PILLOW
+    return backend
+
+
+def start_logging(filename=None, level=logging.INFO, filemode='w'):
+    """logs to `filename` (stderr without) from a background thread and returns
+    the started `QueueListener`, which has to be stopped at the end.
+
+    The root logger only puts the records into a queue, so the file is
+    written outside of the processing. Records below `level` are dropped
+    before their messages are formatted. Forked worker processes inherit
+    the queue and log through it, too.
+    """
+    handler = logging.FileHandler(filename, mode=filemode) if filename else logging.StreamHandler()
+    handler.setFormatter(logging.Formatter('%(name)s - %(levelname)s - %(message)s'))
+    try:
+        log_queue = multiprocessing.Queue()
+    except OSError:
+        log_queue = queue.SimpleQueue()
+    root = logging.getLogger()
+    for old_handler in root.handlers[:]:
+        root.removeHandler(old_handler)
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    root.setLevel(level)
+    listener = logging.handlers.QueueListener(log_queue, handler)
+    listener.start()
+    return listener
+
+
+def scan_files(folder, include=SUPPORTED_FILES, exclude=(), recursive=False, skip_folders=()):
+    """yields the absolute file names of all files in `folder` matching one of
+    the `include` patterns and none of the `exclude` patterns.
+
+    Files are yielded while the folders are scanned. The patterns are matched
+    case insensitive against the file name and against the path relative to
+    `folder`. Excluded subfolders and `skip_folders` are not descended into.
+    """
+    include = [pattern.lower() for pattern in include]
+    exclude = [pattern.lower() for pattern in exclude]
+    skip_folders = {abspath(skip_folder) for skip_folder in skip_folders}
+
+    def matches(name, path, patterns):
+        return any(fnmatchcase(name, pattern) or fnmatchcase(path, pattern) for pattern in patterns)
+
+    root = abspath(folder)
+    folders = [root]
+    while folders:
+        current = folders.pop()
+        try:
+            entries = scandir(current)
+        except OSError as error:
+            logging.warning(f"Cannot scan {current}: {error}")
+            continue
+        with entries:
+            for entry in entries:
+                name = entry.name.lower()
+                path = relpath(entry.path, root).lower()
+                if matches(name, path, exclude) or TEMP_FILENAME.match(name):
+                    continue
+                if entry.is_dir(follow_symlinks=False):
+                    if recursive and entry.path not in skip_folders:
+                        folders.append(entry.path)
+                elif matches(name, path, include) and entry.is_file():
+                    yield entry.path
+
+
+def is_excluded(path, exclude):
+    """returns True if `path`, relative to the scanned folder, or one of its
+    folders matches one of the `exclude` patterns like in `scan_files`"""
+    parts = path.lower().split(sep)
+    patterns = [pattern.lower() for pattern in exclude]
+    return any(fnmatchcase(parts[index], pattern) or fnmatchcase(sep.join(parts[:index + 1]), pattern)
+               for index in range(len(parts)) for pattern in patterns)
+
+
+def read_manifest(filename, key='output'):
+    """yields the entries of a manifest file, invalid lines and lines without
+    `key` are skipped"""
+    if not exists(filename):
+        return
+    with open(filename) as manifest_file:
+        for line in manifest_file:
+            try:
+                entry = json.loads(line)
+                entry[key]
+            except (ValueError, KeyError, TypeError):
+                logging.warning(f"Ignoring invalid manifest line in {filename}: {line!r}")
+                continue
+            yield entry
+
+
+def exif_thumbnail(exif):
+    """returns the JPEG data of the thumbnail in IFD1 of the EXIF data or None"""
+    if not exif:
+        return None
+    if exif.startswith(b'Exif\x00\x00'):
+        exif = exif[6:]
+    byte_order = {b'II': '<', b'MM': '>'}.get(exif[:2])
+    if byte_order is None:
+        return None
+    try:
+        ifd0 = struct.unpack_from(byte_order + 'L', exif, 4)[0]
+        count = struct.unpack_from(byte_order + 'H', exif, ifd0)[0]
+        ifd1 = struct.unpack_from(byte_order + 'L', exif, ifd0 + 2 + count * 12)[0]
+        if not ifd1:
+            return None
+        tags = {}
+        for index in range(struct.unpack_from(byte_order + 'H', exif, ifd1)[0]):
+            entry = ifd1 + 2 + index * 12
+            tag, field_type = struct.unpack_from(byte_order + 'HH', exif, entry)
+            # SHORT values are stored in the first two bytes of the value field
+            tags[tag] = struct.unpack_from(byte_order + ('H' if field_type == 3 else 'L'), exif, entry + 8)[0]
+    except struct.error:
+        return None
+    offset, length = tags.get(EXIF_THUMBNAIL_OFFSET), tags.get(EXIF_THUMBNAIL_LENGTH)
+    if not offset or not length or offset + length > len(exif):
+        return None
+    data = exif[offset:offset + length]
+    return data if data.startswith(b'\xff\xd8') else None
+
+
+def parse_shard(value):
+    """parses a shard like "2/4" into (2, 4). Raises ValueError if it is invalid."""
+    if value is None or isinstance(value, tuple):
+        return value
+    try:
+        index, count = (int(part) for part in str(value).split('/'))
+    except ValueError:
+        raise ValueError(f"invalid shard '{value}', expected K/N") from None
+    if not 1 <= index <= count:
+        raise ValueError(f"invalid shard '{value}', K must be between 1 and N")
+    return index, count
+
+
+def shard_index(path, count):
+    """stable shard (from 0 to count - 1) of a path relative to the source folder.
+    It is the same on every machine and operating system."""
+    digest = hashlib.sha1(path.replace('\\', '/').encode('utf-8')).hexdigest()
+    return int(digest, 16) % count
+
+
+def file_hash(filename, chunk_size=1 << 20):
+    """sha1 hash of the content of a file, read in chunks"""
+    sha1 = hashlib.sha1()
+    with open(filename, 'rb') as hashed_file:
+        for chunk in iter(lambda: hashed_file.read(chunk_size), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
 def to_int_or_none(value, multiplier=1):
     try:
         return int(value) * multiplier
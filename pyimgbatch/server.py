@@ -0,0 +1,298 @@
+import hashlib
+import logging
+import tempfile
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from fnmatch import fnmatchcase
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from os import makedirs, remove, replace, scandir, stat, utime
+from os.path import abspath, basename, commonpath, isfile, join, realpath, relpath
+from urllib.parse import unquote, urlsplit
+
+from PIL import Image
+
+try:
+    from .pyimgbatch import OPTIONKEY, Project, SourceImage, color_transforms, is_excluded
+except ImportError:  # imported as a top level module by the tests
+    from pyimgbatch import OPTIONKEY, Project, SourceImage, color_transforms, is_excluded
+
+DISK_CACHE_SIZE = 512 * 1024 * 1024
+MEMORY_CACHE_SIZE = 64 * 1024 * 1024
+
+
+class MemoryCache(object):
+    """LRU cache of rendered variants, bounded by the total size in bytes."""
+
+    def __init__(self, max_size=MEMORY_CACHE_SIZE):
+        self.max_size = max_size
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            data = self._entries.get(key)
+            if data is not None:
+                self._entries.move_to_end(key)
+            return data
+
+    def put(self, key, data):
+        if len(data) > self.max_size:
+            return
+        with self._lock:
+            if key in self._entries:
+                self.size -= len(self._entries.pop(key))
+            self._entries[key] = data
+            self.size += len(data)
+            while self.size > self.max_size:
+                self.size -= len(self._entries.popitem(last=False)[1])
+
+
+class DiskCache(object):
+    """Cache of rendered variants in `folder`, bounded by the total size in bytes.
+
+    Every variant is stored in a file named by its key. The least recently
+    used files are removed when the cache grows beyond `max_size`. The use is
+    tracked by the modification time of the files, so the order survives a
+    restart of the server.
+    """
+
+    def __init__(self, folder, max_size=DISK_CACHE_SIZE):
+        self.folder = folder
+        self.max_size = max_size
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        makedirs(folder, exist_ok=True)
+        with scandir(folder) as entries:
+            files = [(entry.stat().st_mtime_ns, entry.name, entry.stat().st_size)
+                     for entry in entries if entry.is_file() and not entry.name.startswith('.')]
+        for _, name, size in sorted(files):
+            self._entries[name] = size
+            self.size += size
+        self._evict()
+
+    def _filename(self, key):
+        return join(self.folder, key)
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._entries:
+                return None
+            self._entries.move_to_end(key)
+        try:
+            with open(self._filename(key), 'rb') as cached_file:
+                data = cached_file.read()
+            utime(self._filename(key))
+        except OSError:
+            with self._lock:
+                self.size -= self._entries.pop(key, 0)
+            return None
+        return data
+
+    def put(self, key, data):
+        if len(data) > self.max_size:
+            return
+        with tempfile.NamedTemporaryFile(dir=self.folder, prefix='.', delete=False) as temp_file:
+            temp_file.write(data)
+        replace(temp_file.name, self._filename(key))
+        with self._lock:
+            self.size += len(data) - self._entries.pop(key, 0)
+            self._entries[key] = len(data)
+            self._evict()
+
+    def _evict(self):
+        while self.size > self.max_size:
+            key, size = self._entries.popitem(last=False)
+            self.size -= size
+            try:
+                remove(self._filename(key))
+            except OSError as error:
+                logging.warning(f"Cannot remove cached file {key}: {error}")
+
+
+class VariantCache(object):
+    """Two-tier cache of rendered variants: memory first, then disk.
+
+    Concurrent requests of a variant, which is in neither cache, are coalesced:
+    the first request renders it and the others wait for its result. The
+    counters are changed under the lock, as the requests run in threads.
+    """
+
+    def __init__(self, memory, disk):
+        self.memory = memory
+        self.disk = disk
+        self.hits = {'memory': 0, 'disk': 0}
+        self.renders = 0
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, render):
+        data = self.memory.get(key)
+        if data is not None:
+            with self._lock:
+                self.hits['memory'] += 1
+            return data
+        with self._lock:
+            future = self._pending.get(key)
+            owner = future is None
+            if owner:
+                future = self._pending[key] = Future()
+        if not owner:
+            return future.result()
+        try:
+            data = self.disk.get(key)
+            if data is None:
+                data = render()
+                with self._lock:
+                    self.renders += 1
+                self.disk.put(key, data)
+            else:
+                with self._lock:
+                    self.hits['disk'] += 1
+            self.memory.put(key, data)
+            future.set_result(data)
+            return data
+        except BaseException as error:
+            future.set_exception(error)
+            raise
+        finally:
+            with self._lock:
+                del self._pending[key]
+
+
+class NotFound(Exception):
+    pass
+
+
+class ThumbnailServer(object):
+    """Renders the outputs of the projects on request.
+
+    A variant is addressed by `/<project>/<config name>/<image>`, where the
+    image is the path of the source image relative to the source folder of the
+    project. Projects without a name are addressed by their index.
+    """
+
+    def __init__(self, options, cache):
+        self.cache = cache
+        self.projects = {}
+        for index, project_dict in enumerate(options.get_projects()):
+            plan = Project(dict(project_dict, **{OPTIONKEY.PILLOWONLY: 'serve'}), defaults=options).plan
+            outputs = {output.config_name: output for output in plan.outputs}
+            self.projects[plan.project_name or str(index)] = (plan, outputs)
+
+    def resolve(self, path):
+        """returns the output plan and the source file name of an URL path"""
+        parts = [unquote(part) for part in urlsplit(path).path.split('/') if part]
+        if len(parts) < 3 or parts[0] not in self.projects:
+            raise NotFound(path)
+        plan, outputs = self.projects[parts[0]]
+        output = outputs.get(parts[1])
+        if output is None:
+            raise NotFound(path)
+        root = realpath(plan.source)
+        filename = realpath(join(root, *parts[2:]))
+        name = basename(filename).lower()
+        if (commonpath([root, filename]) != root or not isfile(filename)
+                or not any(fnmatchcase(name, pattern.lower()) for pattern in plan.include)
+                or is_excluded(relpath(filename, root), plan.exclude)
+                or (len(parts) > 3 and not plan.recursive)):
+            raise NotFound(path)
+        return output, filename
+
+    @staticmethod
+    def key(output, filename):
+        """cache key of a variant, which changes with the source file and the settings"""
+        source_stat = stat(filename)
+        key = f"{abspath(filename)}\0{source_stat.st_size}\0{source_stat.st_mtime_ns}\0{output.config_hash}"
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def render(output, filename):
+        with SourceImage(filename) as source_image:
+            current_image = source_image.prepare([output])[0]
+            return current_image.encode(current_image.render())
+
+    def variant(self, path):
+        """returns the output plan, the source file name and the cache key of
+        the variant of an URL path without rendering it"""
+        output, filename = self.resolve(path)
+        return output, filename, self.key(output, filename)
+
+    def content(self, output, filename, key):
+        """returns (data, content type) of a variant from the cache or rendered"""
+        data = self.cache.get(key, lambda: self.render(output, filename))
+        return data, Image.MIME.get(output.image_format, 'application/octet-stream')
+
+    def get(self, path):
+        """returns (data, content type, key) of the variant of an URL path"""
+        output, filename, key = self.variant(path)
+        return self.content(output, filename, key) + (key,)
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+
+    server_version = 'pyimgbatch'
+
+    def do_GET(self):
+        self._respond(body=True)
+
+    def do_HEAD(self):
+        self._respond(body=False)
+
+    def _respond(self, body):
+        """answers with the variant, or with 304 before rendering it if the
+        ETag of the request matches"""
+        thumbnails = self.server.thumbnails
+        try:
+            output, filename, key = thumbnails.variant(self.path)
+            etag = f'"{key}"'
+            if self.headers.get('If-None-Match') == etag:
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.end_headers()
+                return
+            data, content_type = thumbnails.content(output, filename, key)
+        except NotFound:
+            self.send_error(404)
+            return
+        except Exception:
+            logging.exception(f"Cannot render {self.path}")
+            self.send_error(500)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('ETag', etag)
+        self.end_headers()
+        if body:
+            self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        logging.info(f"{self.address_string()} {format % args}")
+
+
+def create_server(options, host='127.0.0.1', port=8000, cache_dir='.pyimgbatch-cache',
+                  cache_size=DISK_CACHE_SIZE, memory_size=MEMORY_CACHE_SIZE):
+    """creates a HTTP server rendering the outputs of the projects of `options` on request"""
+    cache = VariantCache(MemoryCache(memory_size), DiskCache(cache_dir, cache_size))
+    server = ThreadingHTTPServer((host, port), RequestHandler)
+    server.daemon_threads = True
+    server.thumbnails = ThumbnailServer(options, cache)
+    return server
+
+
+def serve(options, **kwargs):
+    color_transforms.clear()
+    server = create_server(options, **kwargs)
+    host, port = server.server_address[:2]
+    print(f"Serving {len(server.thumbnails.projects)} project(s) on http://{host}:{port}/, stop with Ctrl+C")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        cache = server.thumbnails.cache
+        logging.info(f"Server stopped after {cache.renders} render(s), cache hits: {cache.hits}")
@@ -1,5 +1,40 @@
 import unittest
-from pyimgbatch import to_int_or_none
+import json
+import logging
+import asyncio
+import io
+import pickle
+import struct
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from os import listdir, utime
+from os.path import basename, join, relpath, samefile
+from unittest import mock
+
+from PIL import Image, ImageCms
+
+import pyimgbatch
+import server
+import watch
+from pyimgbatch import to_int_or_none, PyImgBatch
+
+
+def create_image(folder, name, size=(64, 48), mode='RGB', **save_args):
+    filename = join(folder, name)
+    Image.new(mode, size, color='red' if mode != 'CMYK' else (0, 255, 255, 0)).save(filename, **save_args)
+    return filename
+
+
+def outputs(folder):
+    return sorted(name for name in listdir(folder) if not name.startswith('.'))
+
+
+def run_project(project, **args):
+    args.setdefault('no_progress', True)
+    PyImgBatch(args, {'projects': [project]}).exec()
 
 
 class TestToIntOrNone(unittest.TestCase):
@@ -13,5 +48,967 @@ class TestToIntOrNone(unittest.TestCase):
         self.assertEqual(result, 6)
 
 
+class TestSourceImage(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.source = join(self.tmp.name, 'source')
+        self.dest = join(self.tmp.name, 'dest')
+        pyimgbatch.makedirs(self.source)
+        create_image(self.source, 'a.jpg')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_decodes_once_per_source(self):
+        project = {'source': self.source, 'dest': self.dest,
+                   'configs': [{'width': 10, 'suffix': '.w10', 'webset': '@3x'}]}
+        with mock.patch.object(pyimgbatch.Image, 'open', wraps=Image.open) as image_open:
+            run_project(project)
+        self.assertEqual(image_open.call_count, 1)
+        self.assertEqual(outputs(self.dest), ['a.w10@1x.jpg', 'a.w10@2x.jpg', 'a.w10@3x.jpg'])
+
+    def test_skipped_source_is_not_decoded(self):
+        project = {'source': self.source, 'dest': self.dest, 'configs': [{'width': 10}]}
+        run_project(project)
+        with mock.patch.object(pyimgbatch.Image, 'open', wraps=Image.open) as image_open:
+            run_project(project)
+        self.assertEqual(image_open.call_count, 0)
+
+
+class TestExecutor(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.source = join(self.tmp.name, 'source')
+        pyimgbatch.makedirs(self.source)
+        for index in range(4):
+            create_image(self.source, f'{index}.png', size=(40 + index, 30))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def _outputs(self, dest, **options):
+        project = dict(source=self.source, dest=join(self.tmp.name, dest),
+                       configs=[{'width': 20, 'webset': '@2x'}], **options)
+        run_project(project)
+        return outputs(project['dest'])
+
+    def test_thread_pool_matches_serial(self):
+        serial = self._outputs('serial')
+        self.assertEqual(len(serial), 8)
+        self.assertEqual(self._outputs('threads', jobs=3, executor='thread'), serial)
+
+    def test_process_pool_matches_serial(self):
+        self.assertEqual(self._outputs('processes', jobs=2, executor='process'), self._outputs('serial'))
+
+    def test_process_pool_error(self):
+        with open(join(self.source, '2.png'), 'wb') as corrupt_file:
+            corrupt_file.write(b'no image')
+        with self.assertRaises(OSError) as error:
+            self._outputs('processes', jobs=2, executor='process')
+        self.assertEqual(error.exception.source_filename, join(self.source, '2.png'))
+
+    def test_pipeline_matches_serial(self):
+        self.assertEqual(self._outputs('pipeline', jobs=2, pipeline=True), self._outputs('serial'))
+
+    def test_pipeline_takes_work_on_calling_thread(self):
+        project = pyimgbatch.Project({'source': self.source, 'dest': join(self.tmp.name, 'dest'),
+                                      'configs': [{'width': 20}]}, defaults=pyimgbatch.Args({}))
+        threads = []
+
+        def work():
+            for filename in sorted(project._file_names()):
+                threads.append(threading.current_thread())
+                yield filename, project.plan.outputs
+
+        with pyimgbatch.PipelineExecutor(jobs=2, queue_size=1) as executor:
+            done = [filename for filename, _, _ in executor.run(work(), lambda message: None)]
+        self.assertEqual(len(done), 4)
+        self.assertEqual(set(threads), {threading.current_thread()})
+
+
+class TestCascade(unittest.TestCase):
+
+    def test_smaller_variants_derive_from_larger(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            source_image = pyimgbatch.SourceImage(create_image(tmp, 'a.png', size=(900, 600)))
+            configs = [pyimgbatch.ConfigEntry({'width': width, 'cascade': True}) for width in (100, 300, 200)]
+            ordered = source_image.cascade_order(configs)
+            self.assertEqual([config.destination_size.width for config in ordered], [300, 200, 100])
+
+            source_image.converted(('RGB', None), lambda image: image)
+            large = source_image.resize_base((300, 200), 1.5).resize((300, 200))
+            source_image.add_intermediate(large)
+            self.assertIs(source_image.resize_base((100, 66), 1.5), large)
+            self.assertIs(source_image.resize_base((250, 166), 1.5), source_image.image)
+            self.assertIs(source_image.resize_base((100, 100), 1.5), source_image.image)
+            source_image.close()
+
+
+class TestFastDecode(unittest.TestCase):
+
+    def _decoded_size(self, name, width, mode='RGB'):
+        with tempfile.TemporaryDirectory() as tmp:
+            with pyimgbatch.SourceImage(create_image(tmp, name, size=(1600, 1200), mode=mode)) as source_image:
+                source_image.fast_decode([pyimgbatch.ConfigEntry({'width': width})])
+                return source_image.image.size, source_image.size
+
+    def test_jpeg_draft(self):
+        self.assertEqual(self._decoded_size('a.jpg', 180), ((400, 300), (1600, 1200)))
+
+    def test_reduce(self):
+        self.assertEqual(self._decoded_size('a.png', 180), ((400, 300), (1600, 1200)))
+
+    def test_no_reduction_for_palette_and_bilevel_sources(self):
+        self.assertEqual(self._decoded_size('a.png', 180, mode='P'), ((1600, 1200), (1600, 1200)))
+        self.assertEqual(self._decoded_size('a.png', 180, mode='1'), ((1600, 1200), (1600, 1200)))
+        with tempfile.TemporaryDirectory() as tmp:
+            create_image(tmp, 'a.png', size=(800, 600), mode='P')
+            run_project({'source': tmp, 'dest': join(tmp, 'dest'), 'configs': [{'width': 100}]}, fast_decode=True)
+            with Image.open(join(tmp, 'dest', 'a.jpg')) as output:
+                self.assertEqual(output.size, (100, 75))
+
+    def test_no_reduction_for_large_outputs(self):
+        self.assertEqual(self._decoded_size('a.jpg', 1000), ((1600, 1200), (1600, 1200)))
+
+
+def exif_with_thumbnail(thumbnail):
+    """EXIF data with an empty IFD0 and `thumbnail` in IFD1"""
+    data = io.BytesIO()
+    thumbnail.save(data, 'JPEG')
+    header = struct.pack('<2sHL', b'II', 42, 8) + struct.pack('<HL', 0, 14)
+    ifd1 = struct.pack('<H', 2) + struct.pack('<HHLL', 0x0201, 4, 1, 44) + \
+        struct.pack('<HHLL', 0x0202, 4, 1, len(data.getvalue())) + struct.pack('<L', 0)
+    return b'Exif\x00\x00' + header + ifd1 + data.getvalue()
+
+
+class TestEmbeddedThumbnail(unittest.TestCase):
+
+    def _decoded_size(self, thumbnail_size, width):
+        with tempfile.TemporaryDirectory() as tmp:
+            exif = exif_with_thumbnail(Image.new('RGB', thumbnail_size, 'red'))
+            filename = create_image(tmp, 'a.jpg', size=(1600, 1200), exif=exif)
+            with pyimgbatch.SourceImage(filename) as source_image:
+                source_image.prepare([pyimgbatch.ConfigEntry({'width': width, 'embedded_thumbnail': True})])
+                return source_image.image.size, source_image.size
+
+    def test_exif_thumbnail(self):
+        thumbnail = pyimgbatch.exif_thumbnail(exif_with_thumbnail(Image.new('RGB', (16, 12))))
+        self.assertEqual(Image.open(io.BytesIO(thumbnail)).size, (16, 12))
+        self.assertIsNone(pyimgbatch.exif_thumbnail(b'Exif\x00\x00II*\x00'))
+
+    def test_thumbnail(self):
+        self.assertEqual(self._decoded_size((160, 120), 160), ((160, 120), (1600, 1200)))
+
+    def test_thumbnail_too_small(self):
+        self.assertEqual(self._decoded_size((160, 120), 200), ((1600, 1200), (1600, 1200)))
+
+    def test_other_aspect_ratio(self):
+        self.assertEqual(self._decoded_size((160, 90), 100), ((1600, 1200), (1600, 1200)))
+
+    def test_project(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            exif = exif_with_thumbnail(Image.new('RGB', (160, 120), 'blue'))
+            create_image(tmp, 'a.jpg', size=(1600, 1200), exif=exif)
+            dest = join(tmp, 'dest')
+            run_project({'source': tmp, 'dest': dest, 'embedded_thumbnail': True, 'configs': [{'width': 100}]})
+            with Image.open(join(dest, 'a.jpg')) as image:
+                self.assertEqual(image.size, (100, 75))
+                self.assertGreater(image.getpixel((50, 37))[2], 200)
+
+
+class TestStageOrder(unittest.TestCase):
+
+    def _prepare(self, configs, mode='CMYK', size=(400, 300)):
+        with tempfile.TemporaryDirectory() as tmp:
+            with pyimgbatch.SourceImage(create_image(tmp, 'a.tif', size=size, mode=mode)) as source_image:
+                current_images = source_image.prepare([pyimgbatch.ConfigEntry(config) for config in configs])
+                return [(current_image.config_entry.dict, current_image.resize_first) for current_image in current_images]
+
+    def test_resize_first(self):
+        configs = [{'width': 100, 'mode': 'RGB'}, {'width': 50, 'mode': 'L'}, {'width': 200, 'mode': 'RGB'}]
+        self.assertEqual(self._prepare(configs), [(configs[0], True), (configs[2], True), (configs[1], True)])
+
+    def test_convert_first(self):
+        self.assertEqual(self._prepare([{'width': 800, 'mode': 'RGB'}])[0][1], False)
+        self.assertEqual(self._prepare([{'width': 350, 'mode': 'RGB'}, {'width': 300, 'mode': 'RGB'}])[0][1], False)
+        self.assertEqual(self._prepare([{'width': 100, 'mode': 'RGB'}], mode='RGBA')[0][1], False)
+        self.assertEqual(self._prepare([{'width': 100, 'mode': 'RGB', 'strict_color': True}])[0][1], False)
+        self.assertEqual(self._prepare([{'width': 100, 'mode': 'RGB', 'cascade': True}])[0][1], False)
+
+    def test_same_output(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            create_image(tmp, 'a.tif', size=(400, 300), mode='CMYK')
+            for strict_color in (True, False):
+                run_project({'source': tmp, 'dest': join(tmp, str(strict_color)), 'strict_color': strict_color,
+                             'configs': [{'width': 100, 'mode': 'RGB', 'format': 'png'}]})
+            with Image.open(join(tmp, 'True', 'a.png')) as strict, Image.open(join(tmp, 'False', 'a.png')) as image:
+                self.assertEqual(image.tobytes(), strict.tobytes())
+
+
+class TestColorTransforms(unittest.TestCase):
+
+    def test_transform_cache(self):
+        icc_profile = ImageCms.ImageCmsProfile(ImageCms.createProfile('sRGB')).tobytes()
+        cache = pyimgbatch.ColorTransforms(maxsize=2)
+        first = cache.transform(icc_profile, None, 'RGBA', 'RGB')
+        self.assertIs(cache.transform(bytes(icc_profile), 'sRGB', 'RGBA', 'RGB'), first)
+        self.assertIsNot(cache.transform(icc_profile, None, 'RGB', 'RGB'), first)
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+        self.assertIsNone(cache.transform(None, None, 'RGBA', 'RGB'))
+        self.assertIsNone(cache.transform(b'no profile', None, 'RGBA', 'RGB'))
+
+    def test_counters_of_worker_processes(self):
+        icc_profile = ImageCms.ImageCmsProfile(ImageCms.createProfile('sRGB')).tobytes()
+        with tempfile.TemporaryDirectory() as tmp:
+            for name in ['a.png', 'b.png', 'c.png']:
+                create_image(tmp, name, mode='RGBA', icc_profile=icc_profile)
+            run_project({'source': tmp, 'dest': join(tmp, 'dest'), 'configs': [{'width': 10}]},
+                        jobs=2, executor='process')
+        self.assertEqual(pyimgbatch.color_transforms.hits + pyimgbatch.color_transforms.misses, 3)
+
+
+class TestManifest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.source = join(self.tmp.name, 'source')
+        self.dest = join(self.tmp.name, 'dest')
+        pyimgbatch.makedirs(self.source)
+        create_image(self.source, 'a.png')
+        create_image(self.source, 'b.png')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def _created(self, configs=({'width': 10},), **args):
+        messages = []
+        with mock.patch.object(pyimgbatch.Out, 'out', messages.append):
+            run_project({'source': self.source, 'dest': self.dest, 'configs': list(configs)}, **args)
+        return sorted(message.split(': ')[1] for message in messages if message.startswith('creating'))
+
+    def test_only_changed_outputs_are_generated(self):
+        self.assertEqual(self._created(), ['a.jpg', 'b.jpg'])
+        self.assertEqual(self._created(), [])
+        utime(join(self.source, 'a.png'), ns=(0, 0))
+        self.assertEqual(self._created(), ['a.jpg'])
+        create_image(self.source, 'b.png', size=(30, 30))
+        self.assertEqual(self._created(), ['b.jpg'])
+        self.assertEqual(self._created([{'width': 10, 'resample': 'box'}]), ['a.jpg', 'b.jpg'])
+
+    def test_hash_sources(self):
+        with mock.patch.object(pyimgbatch, 'file_hash', wraps=pyimgbatch.file_hash) as file_hash:
+            self.assertEqual(self._created(), ['a.jpg', 'b.jpg'])
+        self.assertEqual(file_hash.call_count, 0)
+        utime(join(self.source, 'a.png'), ns=(0, 0))
+        self.assertEqual(self._created(hash_sources=True), ['a.jpg'])
+        utime(join(self.source, 'a.png'), ns=(10 ** 9, 10 ** 9))
+        self.assertEqual(self._created(hash_sources=True), [])
+
+
+class TestDeduplicate(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.source = join(self.tmp.name, 'source')
+        self.dest = join(self.tmp.name, 'dest')
+        pyimgbatch.makedirs(self.source)
+        create_image(self.source, 'a.png')
+        create_image(self.source, 'b.png')
+        create_image(self.source, 'c.png', size=(30, 30))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_duplicates_are_linked(self):
+        messages = []
+        with mock.patch.object(pyimgbatch.Out, 'out', messages.append):
+            run_project({'source': self.source, 'dest': self.dest, 'dedupe': 'hardlink',
+                         'configs': [{'width': 10}, {'width': 5, 'suffix': '.small'}]})
+        created = sorted(message for message in messages if message.startswith(('creating', 'hardlink')))
+        self.assertEqual(len(created), 6)
+        self.assertEqual(len([message for message in created if message.startswith('creating')]), 4)
+        self.assertTrue(samefile(join(self.dest, 'a.jpg'), join(self.dest, 'b.jpg')))
+        self.assertTrue(samefile(join(self.dest, 'a.small.jpg'), join(self.dest, 'b.small.jpg')))
+
+    def test_identical_configs_are_rendered_once(self):
+        configs = [{'width': 20}, {'width': 10, 'webset': '@2x', 'suffix': '.w10'}]
+        for executor in [{}, {'pipeline': True}]:
+            messages = []
+            with mock.patch.object(pyimgbatch.Out, 'out', messages.append):
+                run_project({'source': self.source, 'dest': self.dest, 'include': ['c.png'],
+                             'override': True, 'configs': configs}, **executor)
+            self.assertEqual(sorted(message.split(':')[0] for message in messages if ': ' in message),
+                             ['copy', 'creating', 'creating'])
+            with Image.open(join(self.dest, 'c.jpg')) as image, Image.open(join(self.dest, 'c.w10@2x.jpg')) as copy:
+                self.assertEqual(image.size, copy.size)
+        with open(join(self.source, 'c.png'), 'rb') as source_file:
+            results = list(pyimgbatch.process_images([('c.png', source_file)], configs))
+        self.assertEqual(results[0][1], results[2][1])
+
+    def test_materialize_copy(self):
+        source = create_image(self.tmp.name, 'x.png')
+        destination = join(self.dest, 'sub', 'x.png')
+        self.assertEqual(pyimgbatch.materialize(source, destination, 'copy'), 'copy')
+        self.assertFalse(samefile(source, destination))
+        self.assertIn(pyimgbatch.materialize(source, destination, 'reflink'), ['reflink', 'copy'])
+        with open(source, 'rb') as source_file, open(destination, 'rb') as destination_file:
+            self.assertEqual(source_file.read(), destination_file.read())
+        self.assertEqual(listdir(join(self.dest, 'sub')), ['x.png'])
+
+
+class TestShard(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.source = join(self.tmp.name, 'source')
+        self.dest = join(self.tmp.name, 'dest')
+        pyimgbatch.makedirs(self.source)
+        for index in range(8):
+            create_image(self.source, f'{index}.png')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def _merge(self):
+        project = {'source': self.source, 'dest': self.dest, 'configs': [{'width': 10}]}
+        return pyimgbatch.Project(project, defaults=pyimgbatch.Args({})).merge_shards()
+
+    def test_parse_shard(self):
+        self.assertEqual(pyimgbatch.parse_shard('2/4'), (2, 4))
+        for value in ['0/4', '5/4', '2', 'a/b']:
+            with self.assertRaises(ValueError):
+                pyimgbatch.parse_shard(value)
+
+    def test_shards_are_disjoint_and_merged(self):
+        for shard in ['1/3', '2/3', '3/3']:
+            run_project({'source': self.source, 'dest': self.dest, 'configs': [{'width': 10}]},
+                        shard=shard, manifest=False)
+        self.assertEqual(len(outputs(self.dest)), 8)
+        self.assertEqual(self._merge(), ([], []))
+        self.assertEqual(listdir(self.dest).count(pyimgbatch.MANIFEST_FILENAME), 1)
+        self.assertEqual(len(list(pyimgbatch.read_manifest(join(self.dest, pyimgbatch.MANIFEST_FILENAME)))), 8)
+
+    def test_merge_reports_missing_outputs(self):
+        run_project({'source': self.source, 'dest': self.dest, 'configs': [{'width': 10}]}, shard='1/2')
+        missing, twice = self._merge()
+        self.assertEqual(len(missing), 8 - len(outputs(self.dest)))
+        self.assertEqual(twice, [])
+        self.assertEqual(len([name for name in listdir(self.dest) if '.shard-' in name]), 1)
+
+    def test_merge_without_shard_manifests(self):
+        run_project({'source': self.source, 'dest': self.dest, 'configs': [{'width': 10}]}, manifest=False)
+        with self.assertLogs(level='WARNING'):
+            self.assertIsNone(self._merge())
+        self.assertNotIn(pyimgbatch.MANIFEST_FILENAME, listdir(self.dest))
+
+    def test_journal_per_shard(self):
+        other = pyimgbatch.Journal(self.dest, shard=(2, 2))
+        other.record(join(self.source, '0.png'), [pyimgbatch.ConfigEntry({'width': 10})])
+        other.flush()
+        run_project({'source': self.source, 'dest': self.dest, 'configs': [{'width': 10}]}, shard='1/2')
+        self.assertEqual([name for name in listdir(self.dest) if 'journal' in name],
+                         [pyimgbatch.SHARD_JOURNAL_FILENAME.format(index=2, count=2)])
+
+
+class TestJournal(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.source = join(self.tmp.name, 'source')
+        self.dest = join(self.tmp.name, 'dest')
+        pyimgbatch.makedirs(self.source)
+        for name in ['a.png', 'b.png', 'c.png']:
+            create_image(self.source, name)
+        self.project = {'source': self.source, 'dest': self.dest, 'configs': [{'width': 10}]}
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_failed_write_leaves_no_output(self):
+        with mock.patch.object(Image.Image, 'save', side_effect=OSError('disk full')):
+            with self.assertRaises(OSError):
+                run_project(self.project)
+        self.assertEqual(listdir(self.dest), [])
+
+    def test_output_mode(self):
+        run_project(self.project)
+        self.assertEqual(pyimgbatch.stat(join(self.dest, 'a.jpg')).st_mode & 0o777, 0o666 & ~pyimgbatch.UMASK)
+        pyimgbatch.chmod(join(self.dest, 'b.jpg'), 0o640)
+        create_image(self.source, 'b.png', size=(30, 30))
+        run_project(self.project)
+        self.assertEqual(pyimgbatch.stat(join(self.dest, 'b.jpg')).st_mode & 0o777, 0o640)
+
+    def test_stale_temp_files_are_removed(self):
+        pyimgbatch.makedirs(self.dest)
+        stale = create_image(self.dest, '.a.jpg.k2x_9f0q.tmp.jpg')
+        run_project(self.project, shard='1/2')
+        self.assertIn(basename(stale), listdir(self.dest))
+        run_project(self.project)
+        self.assertNotIn(basename(stale), listdir(self.dest))
+        manifest = pyimgbatch.Manifest(self.dest)
+        self.assertEqual(sorted(manifest.entries), ['a.jpg', 'b.jpg', 'c.jpg'])
+
+    def test_resume(self):
+        save = pyimgbatch.CurrentImage.save
+        saved = []
+
+        def crash(current_image, image):
+            if len(saved) == 2:
+                raise KeyboardInterrupt
+            saved.append(current_image.destination_basename)
+            return save(current_image, image)
+
+        with mock.patch.object(pyimgbatch.CurrentImage, 'save', crash):
+            with self.assertRaises(KeyboardInterrupt):
+                run_project(self.project)
+        with open(join(self.dest, pyimgbatch.JOURNAL_FILENAME)) as journal_file:
+            self.assertEqual(len(journal_file.readlines()), 2)
+        with mock.patch.object(pyimgbatch.Manifest, 'is_current', return_value=False) as is_current:
+            run_project(self.project, resume=True)
+        self.assertEqual(is_current.call_count, 1)
+        self.assertEqual(outputs(self.dest), ['a.jpg', 'b.jpg', 'c.jpg'])
+        self.assertNotIn(pyimgbatch.JOURNAL_FILENAME, listdir(self.dest))
+
+    def test_resume_with_added_config(self):
+        save = pyimgbatch.CurrentImage.save
+        saved = []
+
+        def crash(current_image, image):
+            if len(saved) == 2:
+                raise KeyboardInterrupt
+            saved.append(current_image.destination_basename)
+            return save(current_image, image)
+
+        self.project['configs'] = [{'width': 10, 'suffix': '_a'}]
+        with mock.patch.object(pyimgbatch.CurrentImage, 'save', crash):
+            with self.assertRaises(KeyboardInterrupt):
+                run_project(self.project)
+        self.project['configs'].append({'width': 10, 'suffix': '_b'})
+        run_project(self.project, resume=True)
+        self.assertEqual(outputs(self.dest), ['a_a.jpg', 'a_b.jpg', 'b_a.jpg', 'b_b.jpg', 'c_a.jpg', 'c_b.jpg'])
+
+
+class TestEstimate(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.source = join(self.tmp.name, 'source')
+        self.dest = join(self.tmp.name, 'dest')
+        pyimgbatch.makedirs(self.source)
+        create_image(self.source, 'a.png', size=(1000, 500))
+        create_image(self.source, 'b.jpg', size=(500, 1000))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_metadata_index(self):
+        with pyimgbatch.MetadataIndex(self.dest) as metadata:
+            header = metadata.get(join(self.source, 'a.png'))
+            self.assertEqual((header['width'], header['height'], header['mode'], header['format']), (1000, 500, 'RGB', 'PNG'))
+            metadata.get(join(self.source, 'a.png'))
+            self.assertEqual((metadata.hits, metadata.misses), (1, 1))
+        with mock.patch.object(pyimgbatch.Image, 'open') as image_open:
+            with pyimgbatch.MetadataIndex(self.dest) as metadata:
+                self.assertEqual(metadata.get(join(self.source, 'a.png'))['width'], 1000)
+            image_open.assert_not_called()
+        create_image(self.source, 'a.png', size=(10, 10))
+        self.assertEqual(pyimgbatch.MetadataIndex(self.dest).get(join(self.source, 'a.png'))['width'], 10)
+
+    def test_estimate(self):
+        project = pyimgbatch.Project({'source': self.source, 'dest': self.dest, 'configs': [{'width': 100, 'webset': '@2x'}]},
+                                     defaults=pyimgbatch.Args({}))
+        estimate = project.estimate()
+        self.assertEqual((estimate['sources'], estimate['outputs']), (2, 4))
+        self.assertAlmostEqual(estimate['input_mp'], 1.0)
+        self.assertAlmostEqual(estimate['output_mp'], (100 * 50 + 200 * 100 + 100 * 200 + 200 * 400) / 1e6)
+        self.assertGreater(estimate['seconds'], 0)
+        run_project({'source': self.source, 'dest': self.dest, 'configs': [{'width': 100, 'webset': '@2x'}]})
+        self.assertEqual(project.estimate()['outputs'], 0)
+
+    def test_estimate_reads_no_sources(self):
+        project = {'source': self.source, 'dest': self.dest, 'configs': [{'width': 100}]}
+        run_project(project, manifest=False)
+        project = pyimgbatch.Project(project, defaults=pyimgbatch.Args({}))
+        with mock.patch.object(pyimgbatch, 'file_hash') as hash_file:
+            self.assertEqual(project.estimate()['outputs'], 0)
+        hash_file.assert_not_called()
+        self.assertNotIn(pyimgbatch.MANIFEST_FILENAME, listdir(self.dest))
+
+
+class TestBackend(unittest.TestCase):
+
+    configs = [{'width': 40}, {'width': 30, 'mode': 'L', 'format': 'png', 'suffix': '.l'},
+               {'width': 20, 'mode': 'RGBA', 'format': 'webp', 'suffix': '.rgba', 'quality': 60},
+               {'width': 10, 'mode': 'CMYK', 'suffix': '.cmyk', 'max_bytes': 1000}]
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.source = join(self.tmp.name, 'source')
+        pyimgbatch.makedirs(self.source)
+        create_image(self.source, 'a.png', size=(80, 60), mode='RGBA')
+        create_image(self.source, 'b.jpg', size=(80, 60), mode='CMYK')
+        create_image(self.source, 'c.png', size=(80, 60), mode='L')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def _outputs(self, backend):
+        dest = join(self.tmp.name, backend)
+        run_project({'source': self.source, 'dest': dest, 'backend': backend, 'configs': self.configs})
+        result = {}
+        for name in outputs(dest):
+            with Image.open(join(dest, name)) as image:
+                result[name] = (image.size, image.mode, image.format, image.getpixel((2, 2)))
+        return result
+
+    def test_unavailable_backend_falls_back_to_pillow(self):
+        with mock.patch.object(pyimgbatch.BACKENDS['vips'], 'available', False):
+            self.assertIs(pyimgbatch.get_backend('vips'), pyimgbatch.PILLOW)
+        self.assertIs(pyimgbatch.get_backend('unknown'), pyimgbatch.PILLOW)
+
+    def test_pillow_only(self):
+        pillow = pyimgbatch.ConfigEntry({'width': 10}).config_hash
+        with mock.patch.object(pyimgbatch.BACKENDS['vips'], 'available', True), \
+                mock.patch.object(pyimgbatch, '_backend_warnings', set()):
+            self.assertNotEqual(pyimgbatch.ConfigEntry({'width': 10, 'backend': 'vips'}).config_hash, pillow)
+            with self.assertLogs(level='WARNING') as logs:
+                pipeline = pyimgbatch.ConfigEntry({'width': 10, 'backend': 'vips', 'pipeline': True})
+                self.assertEqual((pipeline.backend, pipeline.config_hash), ('pillow', pillow))
+                plan = pyimgbatch._project_plan([{'width': 10}], {'backend': 'vips'})
+                self.assertEqual((plan.outputs[0].backend, plan.outputs[0].config_hash), ('pillow', pillow))
+            self.assertIn('process_images', logs.output[-1])
+        with mock.patch.object(pyimgbatch.BACKENDS['vips'], 'available', False):
+            self.assertEqual(pyimgbatch.ConfigEntry({'width': 10, 'backend': 'vips'}).config_hash, pillow)
+
+    def test_config_hash_of_default_backend(self):
+        self.assertEqual(pyimgbatch.ConfigEntry({'width': 10, 'backend': 'pillow'}).config_hash,
+                         pyimgbatch.ConfigEntry({'width': 10}).config_hash)
+
+    @unittest.skipIf(pyimgbatch.pyvips is None, "pyvips is not installed")
+    def test_vips_matches_pillow(self):
+        pillow = self._outputs('pillow')
+        self.assertEqual(len(pillow), 12)
+        self.assertEqual(self._outputs('vips'), pillow)
+
+
+class TestWatcher(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.source = join(self.tmp.name, 'source')
+        self.dest = join(self.tmp.name, 'dest')
+        pyimgbatch.makedirs(self.source)
+        create_image(self.source, 'a.png')
+        create_image(self.source, 'b.png')
+        project = {'source': self.source, 'dest': self.dest, 'configs': [{'width': 10}]}
+        self.options = PyImgBatch({'no_progress': True}, {'projects': [project]}).options
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def _watcher(self, **kwargs):
+        watcher = watch.Watcher(self.options, **kwargs)
+        self.addCleanup(lambda: [manifest.close() for manifest in watcher.manifests])
+        return watcher
+
+    def test_debounce(self):
+        watcher = self._watcher(debounce=10)
+        now = time.monotonic()
+        with mock.patch.object(watch, 'monotonic', return_value=now):
+            self.assertEqual(watcher._poll(0), [])
+        self.assertEqual(watcher.queue_depth, 2)
+        with mock.patch.object(watch, 'monotonic', return_value=now + 11):
+            self.assertEqual(len(watcher._poll(0)), 2)
+        self.assertEqual(watcher.queue_depth, 0)
+
+    def test_only_changed_files(self):
+        watcher = self._watcher(debounce=0)
+        ready = watcher._poll(0)
+        self.assertEqual(len(ready), 2)
+        watcher._done(0, ready, failed=[])
+        self.assertEqual(watcher._poll(0), [])
+        create_image(self.source, 'a.png', size=(32, 24))
+        self.assertEqual(watcher._poll(0), [join(self.source, 'a.png')])
+
+    def _run(self, watcher, condition):
+        thread = threading.Thread(target=watcher.run)
+        thread.start()
+        try:
+            deadline = time.monotonic() + 10
+            while not condition() and time.monotonic() < deadline:
+                time.sleep(0.01)
+        finally:
+            watcher.stop()
+            thread.join(5)
+        self.assertFalse(thread.is_alive())
+
+    def test_stop(self):
+        watcher = self._watcher(interval=0.01, debounce=0)
+        self._run(watcher, lambda: watcher.processed == 2)
+        self.assertEqual(outputs(self.dest), ['a.jpg', 'b.jpg'])
+
+    def test_corrupt_source(self):
+        with open(join(self.source, 'a.png'), 'wb') as corrupt_file:
+            corrupt_file.write(b'no image')
+        watcher = self._watcher(interval=0.01, debounce=0)
+        with self.assertLogs(level='ERROR') as logs:
+            self._run(watcher, lambda: len(logs.output) >= 2)
+        self.assertEqual(watcher.processed, 1)
+        self.assertEqual(outputs(self.dest), ['b.jpg'])
+        self.assertTrue(all('a.png' in message for message in logs.output))
+
+    def test_failed_files_are_retried(self):
+        watcher = self._watcher(debounce=0, interval=1, max_retry_delay=3)
+        now = time.monotonic()
+        with mock.patch.object(watch, 'monotonic', return_value=now):
+            ready = watcher._poll(0)
+            watcher._done(0, ready, failed=ready)
+            self.assertEqual(watcher._poll(0), [])
+        with mock.patch.object(watch, 'monotonic', return_value=now + 2):
+            self.assertEqual(sorted(watcher._poll(0)), sorted(ready))
+            watcher._done(0, ready, failed=ready[:1])
+        with mock.patch.object(watch, 'monotonic', return_value=now + 4):
+            self.assertEqual(watcher._poll(0), [])
+        with mock.patch.object(watch, 'monotonic', return_value=now + 5):
+            self.assertEqual(watcher._poll(0), ready[:1])
+
+    def test_no_manifest(self):
+        self.options = PyImgBatch({'no_progress': True, 'manifest': False},
+                                  {'projects': [{'source': self.source, 'configs': [{'width': 10}]}]}).options
+        with self.assertRaises(ValueError):
+            watch.Watcher(self.options)
+
+
+class TestServer(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.source = join(self.tmp.name, 'source')
+        pyimgbatch.makedirs(join(self.source, 'private'))
+        create_image(self.source, 'a.png')
+        create_image(self.source, 'b.png')
+        create_image(join(self.source, 'private'), 'c.png')
+        with open(join(self.tmp.name, 'secret.png'), 'w') as secret_file:
+            secret_file.write('secret')
+        project = {'name': 'web', 'source': self.source, 'recursive': True, 'exclude': ['b.png', 'private'],
+                   'configs': [{'width': 10, 'name': 'thumb'}]}
+        self.options = PyImgBatch({}, {'projects': [project]}).options
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_resolve(self):
+        thumbnails = server.ThumbnailServer(self.options, None)
+        output, filename = thumbnails.resolve('/web/thumb/a.png?size=1')
+        self.assertEqual((output.config_name, filename), ('thumb', join(self.source, 'a.png')))
+        for path in ['/other/thumb/a.png', '/web/other/a.png', '/web/thumb/missing.png', '/web/thumb',
+                     '/web/thumb/b.png', '/web/thumb/private/c.png', '/web/thumb/../secret.png',
+                     '/web/thumb/%2e%2e/secret.png', '/web/thumb/..%2fsecret.png']:
+            with self.assertRaises(server.NotFound, msg=path):
+                thumbnails.resolve(path)
+
+    def test_memory_cache(self):
+        cache = server.MemoryCache(max_size=10)
+        cache.put('a', b'aaaa')
+        cache.put('b', b'bbbb')
+        cache.get('a')
+        cache.put('c', b'cccc')
+        cache.put('d', b'd' * 11)
+        self.assertEqual((cache.get('a'), cache.get('b'), cache.get('c'), cache.get('d')),
+                         (b'aaaa', None, b'cccc', None))
+        self.assertEqual(cache.size, 8)
+
+    def test_disk_cache(self):
+        folder = join(self.tmp.name, 'cache')
+        cache = server.DiskCache(folder, max_size=10)
+        cache.put('a', b'aaaa')
+        cache.put('b', b'bbbb')
+        cache.put('c', b'cccc')
+        self.assertEqual(sorted(listdir(folder)), ['b', 'c'])
+        self.assertEqual(cache.get('b'), b'bbbb')
+        # the file system may not resolve the order of the last uses
+        utime(join(folder, 'c'), ns=(0, 0))
+        cache = server.DiskCache(folder, max_size=4)
+        self.assertEqual((cache.get('b'), cache.get('c'), cache.size), (b'bbbb', None, 4))
+
+    def test_variant_cache_coalesces_renders(self):
+        cache = server.VariantCache(server.MemoryCache(), server.DiskCache(join(self.tmp.name, 'cache')))
+        release = threading.Event()
+        renders = []
+
+        def render():
+            renders.append(1)
+            release.wait(5)
+            return b'data'
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(cache.get('key', render))) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        while not renders:
+            time.sleep(0.01)
+        time.sleep(0.05)
+        release.set()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual((len(renders), results), (1, [b'data'] * 4))
+        self.assertEqual(cache.get('key', render), b'data')
+        self.assertEqual((cache.renders, cache.hits['memory']), (1, 1))
+
+    def test_http(self):
+        http_server = server.create_server(self.options, port=0, cache_dir=join(self.tmp.name, 'cache'))
+        thread = threading.Thread(target=http_server.serve_forever)
+        thread.start()
+        try:
+            url = 'http://{}:{}/web/thumb/a.png'.format(*http_server.server_address[:2])
+            with urllib.request.urlopen(url) as response:
+                etag = response.headers['ETag']
+                self.assertEqual(response.headers['Content-Type'], 'image/jpeg')
+                self.assertEqual(Image.open(io.BytesIO(response.read())).size, (10, 7))
+            request = urllib.request.Request(url, headers={'If-None-Match': etag})
+            with self.assertRaises(urllib.error.HTTPError) as not_modified:
+                urllib.request.urlopen(request)
+            self.assertEqual(not_modified.exception.code, 304)
+            self.assertEqual(http_server.thumbnails.cache.hits, {'memory': 0, 'disk': 0})
+            with self.assertRaises(urllib.error.HTTPError) as not_found:
+                urllib.request.urlopen(url.replace('a.png', 'b.png'))
+            self.assertEqual(not_found.exception.code, 404)
+        finally:
+            http_server.shutdown()
+            http_server.server_close()
+            thread.join(5)
+
+
+class TestScanFiles(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.source = self.tmp.name
+        pyimgbatch.makedirs(join(self.source, 'sub', 'raw'))
+        for name in ['a.jpg', 'B.JPG', 'c.txt', join('sub', 'd.png'), join('sub', 'raw', 'e.tif')]:
+            create_image(self.source, name, format='PNG' if name.endswith('.txt') else None)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def _scan(self, **args):
+        return sorted(relpath(filename, self.source) for filename in pyimgbatch.scan_files(self.source, **args))
+
+    def test_case_insensitive(self):
+        self.assertEqual(self._scan(), ['B.JPG', 'a.jpg'])
+
+    def test_recursive(self):
+        self.assertEqual(self._scan(recursive=True), ['B.JPG', 'a.jpg', 'sub/d.png', 'sub/raw/e.tif'])
+        self.assertEqual(self._scan(recursive=True, exclude=['raw']), ['B.JPG', 'a.jpg', 'sub/d.png'])
+        self.assertEqual(self._scan(recursive=True, include=['sub/*']), ['sub/d.png', 'sub/raw/e.tif'])
+
+    def test_recursive_project_mirrors_folders(self):
+        dest = join(self.source, 'dest')
+        run_project({'source': self.source, 'dest': dest, 'recursive': True, 'configs': [{'width': 10}]})
+        self.assertEqual(outputs(dest), ['B.jpg', 'a.jpg', 'sub'])
+        self.assertEqual(outputs(join(dest, 'sub')), ['d.jpg', 'raw'])
+
+
+class TestInstrumentation(unittest.TestCase):
+
+    def test_stage_report(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            create_image(tmp, 'a.png')
+            report = join(tmp, 'report.json')
+            run_project({'source': tmp, 'dest': join(tmp, 'dest'), 'configs': [{'width': 10}, {'width': 20, 'suffix': '.w20'}]},
+                        report=report)
+            with open(report) as report_file:
+                summary = pyimgbatch.json.load(report_file)
+        self.assertEqual(list(summary['stages']), pyimgbatch.STAGES[1:])
+        self.assertEqual(summary['stages']['save']['count'], 2)
+        self.assertEqual(sorted(summary['configs']), ['*.jpg', '*.w20.jpg'])
+        self.assertFalse(pyimgbatch.instrumentation.enabled or pyimgbatch.NULL_TIMER.events)
+
+
+class TestEventLog(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.source = join(self.tmp.name, 'source')
+        pyimgbatch.makedirs(self.source)
+        create_image(self.source, 'a.png')
+        create_image(self.source, 'b.png')
+        self.events = join(self.tmp.name, 'events.jsonl')
+        self.project = {'source': self.source, 'dest': join(self.tmp.name, 'dest'), 'configs': [{'width': 10}]}
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def read_events(self):
+        with open(self.events) as events_file:
+            return [json.loads(line) for line in events_file]
+
+    def test_events(self):
+        run_project(self.project, events=self.events)
+        run_project(self.project, events=self.events)
+        events = self.read_events()
+        names = [event['event'] for event in events]
+        self.assertEqual(names.count('run_started'), 2)
+        self.assertEqual(names.count('started'), 2)
+        self.assertEqual(names.count('skipped'), 2)
+        finished = [event for event in events if event['event'] == 'finished']
+        self.assertEqual([basename(event['outputs'][0]) for event in finished], ['a.jpg', 'b.jpg'])
+        self.assertIn('save', [event['stage'] for event in events if event['event'] == 'stage'])
+        self.assertFalse(pyimgbatch.instrumentation.enabled)
+
+    def test_started_when_processing_starts(self):
+        for index in range(8):
+            create_image(self.source, f'{index}.png')
+        self.project.update(jobs=2, executor='thread', max_memory=1000)
+        run_project(self.project, events=self.events)
+        names = [event['event'] for event in self.read_events() if event['event'] in ('started', 'finished')]
+        self.assertEqual(names.count('started'), 10)
+        # at most two tasks per worker are submitted before the first one is done
+        self.assertEqual(names.index('finished'), 4)
+
+    def test_started_in_pipeline(self):
+        run_project(dict(self.project, pipeline=True, jobs=2), events=self.events)
+        names = [event['event'] for event in self.read_events()]
+        self.assertEqual(names.count('started'), 2)
+        self.assertEqual(names.count('finished'), 2)
+
+    def test_error(self):
+        with mock.patch.object(Image.Image, 'save', side_effect=OSError('disk full')):
+            with self.assertRaises(OSError):
+                run_project(self.project, events=self.events)
+        error = [event for event in self.read_events() if event['event'] == 'error'][0]
+        self.assertEqual(error['source'], join(self.source, 'a.png'))
+        self.assertEqual(error['error'], 'OSError: disk full')
+        self.assertEqual(self.read_events()[-1]['event'], 'run_finished')
+
+
+class TestLogging(unittest.TestCase):
+
+    def test_start_logging(self):
+        root = logging.getLogger()
+        handlers, level = root.handlers[:], root.level
+        with tempfile.TemporaryDirectory() as tmp:
+            filename = join(tmp, 'test.log')
+            listener = pyimgbatch.start_logging(filename, logging.INFO)
+            try:
+                with mock.patch.object(pyimgbatch.Size, '__str__') as size_str:
+                    logging.debug("%s", pyimgbatch.Size((1, 1)))
+                logging.info("%s done", 'a.jpg')
+            finally:
+                listener.stop()
+                root.handlers[:], root.level = handlers, level
+            with open(filename) as log_file:
+                self.assertEqual(log_file.read(), 'root - INFO - a.jpg done\n')
+        size_str.assert_not_called()
+
+
+class TestPlan(unittest.TestCase):
+
+    def setUp(self):
+        options = pyimgbatch.Options({'projects': [{'prefix': 'web.', 'source': 'src',
+                                                    'configs': [{'width': 10, 'webset': '@2x', 'resample': 'box'}]}]},
+                                     defaults=pyimgbatch.Args({'jobs': None}))
+        self.plan = pyimgbatch.Project(options.get_projects()[0], defaults=options).plan
+
+    def test_resolved_outputs(self):
+        self.assertEqual(self.plan.jobs, 1)
+        self.assertEqual([output.label for output in self.plan.outputs], ['web.*@1x.jpg', 'web.*@2x.jpg'])
+        output = self.plan.outputs[1]
+        self.assertEqual((output.destination_size.width, output.resample_name), (20, 'box'))
+        self.assertEqual(pyimgbatch.CurrentImage('src/a.png', output).destination_basename, 'web.a@2x.jpg')
+
+    def test_immutable_and_picklable(self):
+        output = self.plan.outputs[0]
+        with self.assertRaises(AttributeError):
+            output.prefix = 'other.'
+        copy = pickle.loads(pickle.dumps(output))
+        self.assertEqual((copy.label, copy.config_hash), (output.label, output.config_hash))
+
+    def test_config_name(self):
+        self.assertEqual([output.config_name for output in self.plan.outputs], ['web.@1x.jpg', 'web.@2x.jpg'])
+        config_entry = pyimgbatch.ConfigEntry({'name': 'thumb', 'websetaddon': '@2x'},
+                                              defaults=pyimgbatch.Project({'name': 'project'}))
+        self.assertEqual(config_entry.config_name, 'thumb@2x')
+
+
+class TestMemoryScheduler(unittest.TestCase):
+
+    def test_largest_first_under_budget(self):
+        estimates = {'small': 10, 'medium': 40, 'large': 60, 'huge': 200}
+        with mock.patch.object(pyimgbatch, 'estimate_memory', lambda filename, config_entries, metadata: estimates[filename]):
+            scheduler = pyimgbatch.MemoryScheduler([(name, []) for name in estimates], max_bytes=100)
+        running = []
+
+        def admit():
+            admitted = []
+            for filename, config_entries, estimate in scheduler.admit(lambda: len(running)):
+                running.append(estimate)
+                admitted.append(filename)
+            return admitted
+
+        self.assertEqual(admit(), ['huge'])
+        self.assertEqual(admit(), [])
+        scheduler.release(running.pop())
+        self.assertEqual(admit(), ['large', 'medium'])
+        self.assertEqual(scheduler.in_use, 100)
+
+    def test_estimate_from_header(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            filename = create_image(tmp, 'a.png', size=(100, 50), mode='L')
+            config_entries = [pyimgbatch.ConfigEntry({'width': 10})]
+            self.assertEqual(pyimgbatch.estimate_memory(filename, config_entries), 100 * 50 * (1 + 4) + 10 * 5 * 4)
+
+
+class TestEncoder(unittest.TestCase):
+
+    def setUp(self):
+        self.image = Image.radial_gradient('L').convert('RGB').resize((300, 200))
+
+    def test_encoder_options(self):
+        config_entry = pyimgbatch.ConfigEntry({'format': 'webp', 'quality': 70, 'progressive': True})
+        self.assertEqual(config_entry.image_format, 'WEBP')
+        self.assertEqual(config_entry.encoder_options, (('quality', 70),))
+
+    def test_max_bytes(self):
+        largest = len(pyimgbatch.encode(self.image, 'JPEG', {'quality': 95}))
+        data = pyimgbatch.encode_to_size(self.image, 'JPEG', {}, largest - 1)
+        self.assertLess(len(data), largest)
+        self.assertEqual(pyimgbatch.encode_to_size(self.image, 'JPEG', {}, largest), pyimgbatch.encode(self.image, 'JPEG', {'quality': 95}))
+        smallest = pyimgbatch.encode_to_size(self.image, 'JPEG', {}, 1)
+        self.assertEqual(smallest, pyimgbatch.encode(self.image, 'JPEG', {'quality': pyimgbatch.MIN_QUALITY}))
+
+
+class TestProcessImages(unittest.TestCase):
+
+    def setUp(self):
+        buffer = io.BytesIO()
+        Image.new('RGB', (64, 48)).save(buffer, 'JPEG')
+        self.data = buffer.getvalue()
+
+    def test_outputs(self):
+        results = pyimgbatch.process_images([('in/a.jpg', self.data), ('b.jpg', io.BytesIO(self.data))],
+                                            [{'width': 16, 'webset': '@2x'}, {'width': 8, 'format': 'png'}])
+        self.assertEqual([(name, metadata['size']) for name, _, metadata in results],
+                         [('in/a@1x.jpg', (16, 12)), ('in/a@2x.jpg', (32, 24)), ('in/a.png', (8, 6)),
+                          ('b@1x.jpg', (16, 12)), ('b@2x.jpg', (32, 24)), ('b.png', (8, 6))])
+
+    def test_lazy(self):
+        def images():
+            yield 'a.jpg', self.data
+            raise AssertionError("read ahead")
+        name, data, metadata = next(pyimgbatch.process_images(images(), {'configs': [{'width': 16}]}))
+        self.assertEqual(name, 'a.jpg')
+        self.assertEqual(len(data), metadata['bytes'])
+        self.assertEqual(Image.open(io.BytesIO(data)).size, (16, 12))
+
+    def test_async(self):
+        async def collect():
+            return [result async for result in pyimgbatch.aprocess_images([('a.jpg', self.data)], [{'width': 16}])]
+        expected = list(pyimgbatch.process_images([('a.jpg', self.data)], [{'width': 16}]))
+        self.assertEqual(asyncio.run(collect()), expected)
+
+
 if __name__ == "__main__":
     unittest.main()
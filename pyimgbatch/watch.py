@@ -0,0 +1,137 @@
+import logging
+import signal
+import threading
+from os import stat
+from time import monotonic
+
+try:
+    from .pyimgbatch import Out, Project, color_transforms, created_folders
+except ImportError:  # imported as a top level module by the tests
+    from pyimgbatch import Out, Project, color_transforms, created_folders
+
+
+class Watcher(object):
+    """Watches the source folders of all projects and processes new or modified files.
+
+    The resolved projects, their config entries and manifests stay loaded
+    between the polls. A file is processed when its size and modification time
+    did not change for `debounce` seconds, so files still being copied are not
+    picked up. The first poll processes all outdated files, like a normal run.
+    A source, which cannot be processed, is logged and retried after a delay,
+    which doubles with every failure up to `max_retry_delay` seconds, the
+    other sources are processed anyway. A modified source is retried at once.
+
+    The manifest is required, as it detects modified sources.
+    """
+
+    def __init__(self, options, interval=2.0, debounce=1.0, max_retry_delay=300.0):
+        self.options = options
+        self.interval = interval
+        self.debounce = debounce
+        self.max_retry_delay = max_retry_delay
+        self.projects = [Project(project, defaults=options) for project in options.get_projects()]
+        self.manifests = [project.open_manifest() for project in self.projects]
+        if not all(manifest.enabled for manifest in self.manifests):
+            raise ValueError("Watch mode needs the manifest to detect modified sources, "
+                             "it cannot be combined with --no-manifest")
+        self._seen = [{} for _ in self.projects]
+        self._pending = [{} for _ in self.projects]
+        self._taken = [{} for _ in self.projects]
+        self._failures = [{} for _ in self.projects]
+        self._stop = threading.Event()
+        self.processed = 0
+
+    def stop(self, *args):
+        logging.info("Stopping watch mode")
+        self._stop.set()
+
+    @property
+    def queue_depth(self):
+        return sum(len(pending) for pending in self._pending)
+
+    def _poll(self, index):
+        """moves new or modified files into the pending queue and returns the
+        pending files, which are due: unchanged for `debounce` seconds or, after
+        a failure, for the retry delay"""
+        project, seen, pending = self.projects[index], self._seen[index], self._pending[index]
+        now = monotonic()
+        for filename in project._file_names():
+            try:
+                source_stat = stat(filename)
+            except OSError:
+                continue
+            state = (source_stat.st_size, source_stat.st_mtime_ns)
+            if seen.get(filename) == state:
+                continue
+            if filename not in pending or pending[filename][0] != state:
+                pending[filename] = (state, now + self.debounce)
+                self._failures[index].pop(filename, None)
+        ready = [filename for filename, (state, due) in pending.items() if now >= due]
+        for filename in ready:
+            self._taken[index][filename] = pending.pop(filename)[0]
+        return ready
+
+    def _done(self, index, filenames, failed):
+        """marks the processed `filenames` as seen and queues the `failed` ones for a retry"""
+        taken, failures = self._taken[index], self._failures[index]
+        now = monotonic()
+        for filename in filenames:
+            state = taken.pop(filename)
+            if filename in failed:
+                failures[filename] = failures.get(filename, 0) + 1
+                delay = min(self.interval * 2 ** failures[filename], self.max_retry_delay)
+                self._pending[index].setdefault(filename, (state, now + delay))
+            else:
+                failures.pop(filename, None)
+                self._seen[index][filename] = state
+
+    def _process(self, project, filenames, manifest):
+        """processes `filenames` and retries without a failed source until all
+        others are done. Returns the failed sources, all remaining sources if
+        an error belongs to no source. The error event of a failure is emitted
+        by `process`."""
+        remaining = list(filenames)
+        failed = []
+        while remaining:
+            try:
+                project.process(remaining, manifest)
+                return failed
+            except Exception as error:
+                source = getattr(error, 'source_filename', None)
+                logging.error(f"Cannot process {source or 'batch'} of project '{project.project_name}': "
+                              f"{type(error).__name__}: {error}")
+                if source not in remaining:
+                    return failed + remaining
+                remaining.remove(source)
+                failed.append(source)
+        return failed
+
+    def run(self):
+        Out.init_image_bar(True)
+        Out.init_project_bar(True)
+        color_transforms.clear()
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGINT, self.stop)
+            signal.signal(signal.SIGTERM, self.stop)
+        Out.out(f"Watching {len(self.projects)} project(s), stop with Ctrl+C")
+        try:
+            with self.options.instrumented():
+                while not self._stop.is_set():
+                    for index, project in enumerate(self.projects):
+                        ready = self._poll(index)
+                        if ready:
+                            logging.info(f"Processing {len(ready)} file(s) of project '{project.project_name}', "
+                                         f"{self.queue_depth} pending")
+                            self.manifests[index].refresh()
+                            created_folders.clear()
+                            failed = self._process(project, ready, self.manifests[index])
+                            self._done(index, ready, failed)
+                            self.processed += len(ready) - len(failed)
+                            Out.out(f"processed: {len(ready)}, pending: {self.queue_depth}, total: {self.processed}")
+                        if self._stop.is_set():
+                            break
+                    self._stop.wait(self.interval)
+        finally:
+            for manifest in self.manifests:
+                manifest.close()
+            logging.info(f"Watch mode stopped after {self.processed} file(s), {self.queue_depth} pending")
@@ -19,9 +19,14 @@ setuptools.setup(
         "Pillow>=6.2.1",
         "tqdm>=4.36.1"
     ],
-    packages=setuptools.find_packages(),
+    extras_require={
+        "vips": ["pyvips>=2.1"]
+    },
+    packages=setuptools.find_packages(exclude=['benchmarks']),
     classifiers=[
-        "Programming Language :: Python :: 3.6",
+        "Programming Language :: Python :: 3",
+        "Programming Language :: Python :: 3 :: Only",
+        "Programming Language :: Python :: 3.7",
         "License :: OSI Approved :: MIT License",
         "Operating System :: OS Independent",
         "Development Status :: 3 - Alpha",
@@ -36,7 +41,7 @@ setuptools.setup(
         "Topic :: Software Development :: Libraries :: Python Modules",
         "Topic :: Utilities"
     ],
-    python_requires='>=3.6',
+    python_requires='>=3.7',
     version="0.2.7",
     # version_config={
     #     "version_format": "{tag}.dev{sha}",